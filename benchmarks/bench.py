@@ -0,0 +1,204 @@
+"""Offline benchmarks for the placement pipeline.
+
+Uses synthetic templates and a synthetic 3000x2000 board (six 1000x1000
+canvases), so no network access is needed. Run from the repository root:
+
+    python -m benchmarks.bench --out bench_results.json
+
+Results are written as JSON: one entry per measurement with its parameters and
+the best / mean / worst wall time of its repeats, in seconds.
+"""
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+import numpy as np
+import PIL
+from loguru import logger
+from PIL import Image
+
+from benchmarks import synthetic
+from src import utils
+from src.mappings import ColorMapper, Palette
+
+BOARD_ORIGIN = (2273, 1780)  # where config.json puts the real template
+BOARD_SIZE = (3000, 2000)
+
+
+def measure(results, name, fn, repeat=5, setup=None, **params):
+    """Time fn() repeat times (after setup(), untimed) and record the result."""
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    result = {
+        "name": name,
+        "params": params,
+        "repeat": repeat,
+        "best_s": min(timings),
+        "mean_s": sum(timings) / len(timings),
+        "worst_s": max(timings),
+    }
+    results.append(result)
+    print("{:<32} {:<45} best {:.6f}s".format(name, json.dumps(params), result["best_s"]), file=sys.stderr)
+    return result
+
+
+def bench_quantization(results, template_sizes, repeat, cache_dir):
+    palette = Palette.default()
+    rgb_colors_array = palette.rgb_colors_array
+
+    # per-pixel closest_color is far too slow for a whole template, so time a sample
+    sample = np.asarray(synthetic.make_template(100, 100)).reshape(-1, 4)
+    pixels = [tuple(int(v) for v in pixel) for pixel in sample]
+    measure(
+        results,
+        "closest_color",
+        lambda: [ColorMapper.closest_color(p, rgb_colors_array, True) for p in pixels],
+        repeat,
+        pixels=len(pixels),
+    )
+
+    measure(
+        results,
+        "lookup_table_build",
+        lambda: ColorMapper.build_lookup_table(rgb_colors_array),
+        1,
+    )
+    palette.load_lookup_table(cache_dir)
+    measure(results, "lookup_table_load", lambda: palette.load_lookup_table(cache_dir), repeat)
+    lookup_table = palette.load_lookup_table(cache_dir)
+
+    for width, height in template_sizes:
+        rgba = np.asarray(synthetic.make_template(width, height))
+        measure(
+            results,
+            "quantize_image",
+            lambda: palette.quantize_image(rgba, True),
+            repeat,
+            width=width,
+            height=height,
+            lookup_table=False,
+        )
+        measure(
+            results,
+            "quantize_image",
+            lambda: palette.quantize_image(rgba, True, lookup_table),
+            repeat,
+            width=width,
+            height=height,
+            lookup_table=True,
+        )
+
+
+def bench_decode(results, repeat):
+    tile = synthetic.make_tile()
+    png = synthetic.png_bytes(tile)
+    measure(
+        results,
+        "png_decode",
+        lambda: Image.open(BytesIO(png)).convert("RGBA").load(),
+        repeat,
+        width=tile.width,
+        height=tile.height,
+        png_bytes=len(png),
+    )
+
+
+def bench_client(results, workdir, template_sizes, completions, repeat, cache_dir):
+    tile_pngs = [synthetic.png_bytes(synthetic.make_tile(seed)) for seed in range(6)]
+    canvas_details = synthetic.canvas_config()
+
+    for width, height in template_sizes:
+        template = synthetic.make_template(width, height)
+        # keep larger templates on the board
+        origin = tuple(min(o, b - s) for o, b, s in zip(BOARD_ORIGIN, BOARD_SIZE, (width, height)))
+        client = synthetic.make_client(workdir, template, origin, cache_dir)
+
+        measure(results, "load_image", lambda: utils.load_image(client), repeat, width=width, height=height)
+        measure(
+            results,
+            "board_composite",
+            lambda: synthetic.attach_board(client, tile_pngs, canvas_details),
+            repeat,
+            width=width,
+            height=height,
+        )
+
+        board = client.board_mirror.view(*origin, width, height)
+        rng = np.random.default_rng(0)
+        opaque = np.flatnonzero(client.template_opaque)
+        for completion in completions:
+            # paint the right color over a share of the opaque template pixels
+            board[...] = np.where(client.template_opaque, (client.template_indices + 1) % 32, 0)
+            done = rng.choice(opaque, int(len(opaque) * completion), replace=False)
+            board.ravel()[done] = client.template_indices.ravel()[done]
+
+            def reset():
+                client.mismatch_index = None
+
+            measure(
+                results,
+                "sync_board",
+                client.sync_board,
+                repeat,
+                setup=reset,
+                width=width,
+                height=height,
+                completion=completion,
+            )
+            measure(
+                results,
+                "get_unset_pixel",
+                client.get_unset_pixel,
+                repeat,
+                width=width,
+                height=height,
+                completion=completion,
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--out", default="bench_results.json", help="JSON results file")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--quick", action="store_true", help="small templates only")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    template_sizes = [(247, 119), (500, 500)] if args.quick else [(247, 119), (1000, 1000), (2000, 1000)]
+    completions = [0.0, 0.5, 0.9, 0.999]
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        cache_dir = workdir + "/cache"
+        bench_quantization(results, template_sizes, args.repeat, cache_dir)
+        bench_decode(results, args.repeat)
+        bench_client(results, workdir, template_sizes, completions, args.repeat, cache_dir)
+
+    report = {
+        "meta": {
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "pillow": PIL.__version__,
+        },
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Wrote {} results to {}".format(len(results), args.out), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
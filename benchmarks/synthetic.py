@@ -0,0 +1,122 @@
+"""Synthetic templates, boards and an offline PlaceClient for benchmarks and tools.
+
+Nothing here touches the network: the client's template refresh is a no-op and
+its board mirror is filled directly from generated canvas tiles.
+"""
+import json
+import os
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from main import PlaceClient
+from src.board import BoardMirror
+from src.mappings import Palette
+
+CANVAS_SIZE = 1000
+
+
+def canvas_config(columns=3, rows=2, size=CANVAS_SIZE, palette=None):
+    """ConfigurationMessageData for a columns x rows grid of canvases."""
+    palette = palette or Palette.default()
+    return {
+        "__typename": "ConfigurationMessageData",
+        "colorPalette": {
+            "colors": [
+                {"hex": "#%02X%02X%02X" % rgb, "index": index}
+                for index, rgb in palette.colors.items()
+            ]
+        },
+        "canvasConfigurations": [
+            {"index": i, "dx": size * (i % columns), "dy": size * (i // columns)}
+            for i in range(columns * rows)
+        ],
+        "canvasWidth": size,
+        "canvasHeight": size,
+    }
+
+
+def make_template(width, height, transparent_fraction=0.3, seed=0, palette=None):
+    """RGBA template of palette-colored blocks with transparent holes."""
+    palette = palette or Palette.default()
+    rng = np.random.default_rng(seed)
+    colors = np.asarray(palette.rgb_colors_array, dtype=np.uint8)
+
+    # 8x8 blocks look more like pixel art than per-pixel noise and compress like it
+    blocks = rng.integers(0, len(colors), ((height + 7) // 8, (width + 7) // 8))
+    indices = np.kron(blocks, np.ones((8, 8), dtype=blocks.dtype))[:height, :width]
+    rgba = np.empty((height, width, 4), dtype=np.uint8)
+    rgba[..., :3] = colors[indices]
+    rgba[..., 3] = 255
+    rgba[rng.random((height, width)) < transparent_fraction, 3] = 0
+    return Image.fromarray(rgba)
+
+
+def make_tile(seed=0, size=CANVAS_SIZE, palette=None):
+    """Full-frame canvas tile of random palette colors."""
+    palette = palette or Palette.default()
+    rng = np.random.default_rng(seed)
+    colors = np.asarray(palette.rgb_colors_array, dtype=np.uint8)
+    return Image.fromarray(colors[rng.integers(0, len(colors), (size, size))])
+
+
+def png_bytes(image):
+    buffer = BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class OfflineClient(PlaceClient):
+    # the template on disk is the template; nothing is downloaded
+    def update_image(self):
+        return False
+
+
+class OfflineBoardMirror(BoardMirror):
+    """Board mirror fed by hand instead of a websocket."""
+
+    def __init__(self, lookup_table_provider, region, frames):
+        super().__init__(lambda: "", lookup_table_provider, region)
+        self.frames = frames  # frame url -> PNG bytes
+
+    def start(self):
+        pass
+
+    def _fetch_frame(self, url):
+        return self.frames[url]
+
+    def load(self, canvas_details, urls):
+        """Configure and apply one full frame per canvas index in urls, synchronously."""
+        self._configure(canvas_details)
+        for canvas_index in self.tiles:
+            frame = self._decode_frame(canvas_index, urls[canvas_index], diff=False)
+            if frame is not None:
+                self._apply(*frame, diff=False)
+        self.ready.set()
+
+
+def make_client(workdir, template, origin, cache_dir, **config):
+    """OfflineClient for a template image placed at origin, with its files in workdir."""
+    image_path = os.path.join(workdir, "template.png")
+    template.save(image_path)
+    config_path = os.path.join(workdir, "config.json")
+    with open(config_path, "w") as f:
+        json.dump(
+            dict(image_path=image_path, image_start_coords=list(origin), cache_dir=cache_dir, **config),
+            f,
+        )
+    return OfflineClient(config_path)
+
+
+def attach_board(client, tile_pngs, canvas_details=None):
+    """Give an offline client a ready board mirror built from PNG-encoded tiles."""
+    canvas_details = canvas_details or canvas_config()
+    frames = {"tile-{}".format(i): png for i, png in enumerate(tile_pngs)}
+    region = (client.pixel_x_start, client.pixel_y_start, *client.image_size)
+    mirror = OfflineBoardMirror(client.get_lookup_table, region, frames)
+    mirror.add_listener(client.on_board_change)
+    mirror.add_palette_listener(client.on_palette_change)
+    mirror.load(canvas_details, {i: "tile-{}".format(i) for i in range(len(tile_pngs))})
+    client.board_mirror = mirror
+    return mirror
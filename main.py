@@ -1,20 +1,27 @@
+import argparse
+import hashlib
 import math
 import requests
 import json
+import multiprocessing
 import time
-import sys, os
-import random
-from io import BytesIO
+import os
+import threading
 from http import HTTPStatus
-from websocket import create_connection # type: ignore
-from websocket._exceptions import WebSocketConnectionClosedException # type: ignore
-from PIL import Image
 
 from loguru import logger
 from bs4 import BeautifulSoup
 
-from src.mappings import ColorMapper
-from src import utils
+from src.board import WS_URL, BoardMirror
+from src.capture import CaptureLog
+from src.completion import CompletionTracker
+from src.contention import ContentionTracker
+from src.diff import MismatchIndex
+from src.engine import Engine
+from src.mappings import Palette
+from src.metrics import PLACEMENTS, TEMPLATE_PIXELS, Metrics
+from src.profiling import CycleProfiler
+from src import logs, net, priority, template, transport, utils
 
 class PlaceClient:
     def __init__(self, config_path):
@@ -23,19 +30,114 @@ class PlaceClient:
         # Data
         self.json_data = utils.get_json_data(self, config_path)
         logger.debug("{}", self.json_data)
-        self.pixel_x_start: int = self.json_data["image_start_coords"][0]
-        self.pixel_y_start: int = self.json_data["image_start_coords"][1]
-
-        self.rgb_colors_array = ColorMapper.generate_rgb_colors_array()
+        # Compiled template (see compile-template), used instead of the image when current
+        self.template_artifact_path = self.json_data.get(
+            "template_artifact_path",
+            template.artifact_path(self.json_data.get("image_path", "images/image.png")),
+        )
+        image_start_coords = self.json_data.get("image_start_coords")
+        if image_start_coords is None:
+            # a build may ship the compiled template, which knows its origin, without a config entry
+            compiled = template.load_template(self.template_artifact_path)
+            if compiled is None:
+                exit("No image_start_coords in config.json and no compiled template")
+            image_start_coords = compiled.origin
+        self.pixel_x_start: int = image_start_coords[0]
+        self.pixel_y_start: int = image_start_coords[1]
+
+        # Palette, replaced by the one the configuration subscription announces
+        self.palette = Palette.default()
         self.legacy_transparency = True
 
+        # Shared on-disk rgb -> palette index tables, memory-mapped, per palette hash
+        self.cache_dir = self.json_data.get("cache_dir", ".cache")
+        self.lookup_tables = {}
+
+        # Endpoints, overridable to point the client at a local stand-in server
+        self.gql_url = self.json_data.get("gql_url", transport.GQL_URL)
+        self.gql_ws_url = self.json_data.get("gql_ws_url", WS_URL)
+        self.template_base_url = self.json_data.get("template_base_url", "https://us0.co")
+        self.reddit_login_url = self.json_data.get("reddit_login_url", "https://www.reddit.com/login")
+        self.reddit_session_url = self.json_data.get("reddit_session_url", "https://new.reddit.com/")
+
+        # setPixel goes over one keep-alive session; (connect, read) timeouts in seconds
+        self.transport = transport.Transport(
+            self.gql_url,
+            (
+                self.json_data.get("gql_connect_timeout", 5),
+                self.json_data.get("gql_read_timeout", 15),
+            ),
+        )
+
         self.access_token = None
         self.access_token_expiry_timestamp = None
 
+        # Retry delay after a bad setPixel response, doubled for every bad
+        # response in a row up to bad_response_max_delay seconds
+        self.bad_response_delay = self.json_data.get("bad_response_delay", 1)
+        self.bad_response_max_delay = self.json_data.get("bad_response_max_delay", 60)
+        self.bad_responses = 0
+
+        # Stage timings and placement outcomes, served in the Prometheus text
+        # format on metrics_port and/or written to metrics_textfile
+        self.metrics = Metrics()
+        self.metrics_textfile = self.json_data.get("metrics_textfile")
+        metrics_port = self.json_data.get("metrics_port")
+        if metrics_port:
+            self.metrics.serve(int(metrics_port))
+            logger.info("Serving metrics on http://127.0.0.1:{}/metrics", metrics_port)
+
+        # Board, mirrored over a single long-lived websocket
+        self.board_mirror = None
+        self.mismatch_index = None
+        self.board_timeout = self.json_data.get("board_timeout", 120)
+        # Worker processes decoding frame PNGs to palette indices; 0 decodes on
+        # the download threads instead
+        self.frame_processes = self.json_data.get("frame_processes", min(os.cpu_count() or 1, 4))
+        # How often the template and mismatch index are refreshed between placements
+        self.board_resync_interval = self.json_data.get("board_resync_interval", 60)
+        # The mirrored region is saved to cache_dir on every resync; on start a
+        # snapshot younger than board_snapshot_max_age seconds is used right away
+        self.board_snapshot = self.json_data.get("board_snapshot", True)
+        self.board_snapshot_max_age = self.json_data.get("board_snapshot_max_age", 300)
+        # Append every board message and frame image to this file, for tools/replay.py
+        self.capture_path = self.json_data.get("capture_path")
+        self.scheduler = None
+        # resyncs and placements run on separate engine threads
+        self.sync_lock = threading.Lock()
+        # Overwrite counters per template pixel; picks prefer the least contested
+        # of contention_samples equally important candidates
+        self.contention = None
+        self.contention_samples = self.json_data.get("contention_samples", 4)
+        self.contention_heatmap_path = self.json_data.get("contention_heatmap_path")
+        # Correct / wrong / transparent counts, overall and per named template
+        # rectangle in completion_regions ({"name": [left, top, width, height]})
+        self.completion = None
+        self.completion_regions = self.json_data.get("completion_regions", {})
+        self.completion_export_path = self.json_data.get("completion_export_path")
+
          # Image information
-        self.pix = None
+        self.template_rgba = None
+        self.template_indices = None
+        self.template_opaque = None
+        self.template_priorities = None
+        self.template_sparse = None
+        self.quantized_templates = {}
         self.image_size = None
         self.image_path = self.json_data.get("image_path", "images/image.png")
+        # "auto": importance mask next to the template if present, else edge weights
+        self.pixel_priority = self.json_data.get("pixel_priority", "auto")
+        self.importance_mask_path = self.json_data.get(
+            "importance_mask_path", priority.importance_mask_path(self.image_path)
+        )
+
+        # Template refresh state, so unchanged templates are never rewritten or decoded
+        self.template_save_path = os.path.join("./", "image.png") #SET SAVE PATH
+        self.template_hash = utils.hash_file(self.template_save_path)
+        self.template_refresh_interval = self.json_data.get("template_refresh_interval", 60)
+        self.template_checked_at = None
+        self.template_validators = {}
+        self.template_session = net.make_session()
         self.update_image()
         utils.load_image(self)
 
@@ -49,473 +151,400 @@ class PlaceClient:
         color_index_in=18,
         canvas_index=0,
     ):
-        # canvas structure:
-        # 0 | 1 | 2
-        # 3 | 4 | 5
+        geometry = self.board_mirror.geometry
+        board_x, board_y = geometry.to_board(canvas_index, pixel_x_start, pixel_y_start)
         logger.warning(
             "Attempting to place {} pixel at {}, {}",
-            ColorMapper.color_id_to_name(color_index_in),
-            pixel_x_start + (1000 * (canvas_index % 3)),
-            pixel_y_start + (1000 * (canvas_index // 3)),
+            self.palette.describe(color_index_in),
+            board_x,
+            board_y,
         )
 
-        url = "https://gql-realtime-2.reddit.com/query"
-
-        payload = json.dumps(
-            {
-                "operationName": "setPixel",
-                "variables": {
-                    "input": {
-                        "actionName": "r/replace:set_pixel",
-                        "PixelMessageData": {
-                            "coordinate": {"x": pixel_x_start, "y": pixel_y_start},
-                            "colorIndex": color_index_in,
-                            "canvasIndex": canvas_index,
-                        },
-                    }
-                },
-                "query": "mutation setPixel($input: ActInput!) {\n  act(input: $input) {\n    data {\n      ... on BasicMessage {\n        id\n        data {\n          ... on GetUserCooldownResponseMessageData {\n            nextAvailablePixelTimestamp\n            __typename\n          }\n          ... on SetPixelResponseMessageData {\n            timestamp\n            __typename\n          }\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n}\n",
-            }
-        )
-        headers = {
-            "origin": "https://garlic-bread.reddit.com",
-            "referer": "https://garlic-bread.reddit.com/",
-            "apollographql-client-name": "mona-lisa",
-            "Authorization": "Bearer " + access_token,
-            "Content-Type": "application/json",
-        }
-        response = requests.post(
-            url,
-            headers=headers,
-            data=payload,
-        )
-        logger.debug(
-            "Received response: {}", response.text
-        )
-
-        # There are 2 different JSON keys for responses to get the next timestamp.
-        # If we don't get data, it means we've been rate limited.
-        # If we do, a pixel has been successfully placed.
-        if response.json()["data"] is None:
-            logger.debug(response.json().get("errors"))
-
-            try:
-                waitTime = math.floor(
-                    response.json()["errors"][0]["extensions"]["nextAvailablePixelTs"]
-                )
-            except KeyError as e:
-                print("Received bad response. Trying again.")
-                return 0
-
-            logger.error(
+        with self.metrics.time("set_pixel"):
+            result = self.transport.set_pixel(
+                access_token, pixel_x_start, pixel_y_start, color_index_in, canvas_index
+            )
+        self.metrics.count(PLACEMENTS, outcome=result.outcome)
+
+        if result.outcome == transport.BAD_RESPONSE:
+            logger.debug("Bad response: {}", result.data)
+            self.bad_responses += 1
+            delay = min(
+                self.bad_response_delay * 2 ** min(self.bad_responses - 1, 16),
+                self.bad_response_max_delay,
+            )
+            print("Received bad response. Trying again in {} seconds.".format(delay))
+            return time.time() + delay
+        self.bad_responses = 0
+        if result.outcome == transport.RATE_LIMITED:
+            logger.debug(result.data.get("errors"))
+            # routine, and errors dump the debug ring buffer
+            logger.warning(
                 "Failed placing pixel: rate limited",
             )
         else:
-            waitTime = math.floor(
-                response.json()["data"]["act"]["data"][0]["data"][
-                    "nextAvailablePixelTimestamp"
-                ]
-            )
             logger.success(
                 "Succeeded placing pixel at {}, {}",
-                (pixel_x_start + (1000 * (canvas_index % 3))-1500), (pixel_y_start + (1000 * (canvas_index // 3))-1000)
+                *geometry.to_display(board_x, board_y),
             )
 
         # Reddit returns time in ms and we need seconds, so divide by 1000
-        return waitTime / 1000
-
-    def get_board(self, access_token):
-        self.update_image()
-        utils.load_image(self)
-        logger.debug("Connecting and obtaining board images")
-        while True:
-            try:
-                ws = create_connection(
-                    "wss://gql-realtime-2.reddit.com/query",
-                    origin="https://garlic-bread.reddit.com",
-                )
-                break
-            except Exception:
-                logger.error(
-                    "Failed to connect to websocket, trying again in 30 seconds..."
-                )
-                time.sleep(30)
-
-        ws.send(
-            json.dumps(
-                {
-                    "type": "connection_init",
-                    "payload": {"Authorization": "Bearer " + access_token},
-                }
+        return result.next_available / 1000
+
+    def sync_board(self):
+        """Refresh the template and make sure the board mirror and mismatch index are current."""
+        with self.sync_lock:
+            self._sync_board()
+
+    def _sync_board(self):
+        if self.update_image():
+            utils.load_image(self)
+        # only the tiles under the template are mirrored
+        region = (self.pixel_x_start, self.pixel_y_start, *self.image_size)
+        if self.board_mirror is None:
+            logger.debug("Starting board mirror")
+            self.board_mirror = BoardMirror(
+                lambda: self.access_token,
+                self.get_lookup_table,
+                region,
+                self.gql_ws_url,
+                frame_processes=self.frame_processes,
+                metrics=self.metrics,
+                capture=CaptureLog(self.capture_path) if self.capture_path else None,
+                snapshot_dir=self.cache_dir if self.board_snapshot else None,
+                snapshot_max_age=self.board_snapshot_max_age,
             )
-        )
-        while True:
-            try:
-                msg = ws.recv()
-            except WebSocketConnectionClosedException as e:
-                logger.error(e)
-                continue
-            if msg is None:
-                logger.error("Reddit failed to acknowledge connection_init")
-                exit()
-            if msg.startswith('{"type":"connection_ack"}'):
-                logger.debug("Connected to WebSocket server")
-                break
-        logger.debug("Obtaining Canvas information")
-        ws.send(
-            json.dumps(
-                {
-                    "id": "1",
-                    "type": "start",
-                    "payload": {
-                        "variables": {
-                            "input": {
-                                "channel": {
-                                    "teamOwner": "GARLICBREAD",
-                                    "category": "CONFIG",
-                                }
-                            }
-                        },
-                        "extensions": {},
-                        "operationName": "configuration",
-                        "query": "subscription configuration($input: SubscribeInput!) {\n  subscribe(input: $input) {\n    id\n    ... on BasicMessage {\n      data {\n        __typename\n        ... on ConfigurationMessageData {\n          colorPalette {\n            colors {\n              hex\n              index\n              __typename\n            }\n            __typename\n          }\n          canvasConfigurations {\n            index\n            dx\n            dy\n            __typename\n          }\n          canvasWidth\n          canvasHeight\n          __typename\n        }\n      }\n      __typename\n    }\n    __typename\n  }\n}\n",
-                    },
-                }
+            self.board_mirror.add_listener(self.on_board_change)
+            self.board_mirror.add_palette_listener(self.on_palette_change)
+            self.board_mirror.start()
+        else:
+            self.board_mirror.set_region(region)
+        if not self.board_mirror.wait_ready(self.board_timeout):
+            raise TimeoutError("Board mirror has no full frames yet")
+        # the server's palette is known once the mirror is ready; quantizing is a
+        # no-op unless it differs from the one the template was quantized for
+        palette_hash = self.palette.hash
+        utils.quantize_template(self)
+
+        origin = (self.pixel_x_start, self.pixel_y_start)
+        if self.mismatch_index is None or not self.mismatch_index.matches(
+            self.template_indices, origin, self.template_priorities
+        ):
+            index = MismatchIndex(
+                self.template_indices,
+                origin,
+                self.template_opaque,
+                self.template_priorities,
+                self.template_sparse,
             )
-        )
-
-        while True:
-            canvas_payload = json.loads(ws.recv())
-            if canvas_payload["type"] == "data":
-                canvas_details = canvas_payload["payload"]["data"]["subscribe"]["data"]
-                logger.debug("Canvas config: {}", canvas_payload)
-                break
-
-        canvas_sockets = []
-
-        canvas_count = len(canvas_details["canvasConfigurations"])
-
-        for i in range(0, canvas_count):
-            canvas_sockets.append(2 + i)
-            logger.debug("Creating canvas socket {}", canvas_sockets[i])
-
-            ws.send(
-                json.dumps(
-                    {
-                        "id": str(2 + i),
-                        "type": "start",
-                        "payload": {
-                            "variables": {
-                                "input": {
-                                    "channel": {
-                                        "teamOwner": "GARLICBREAD",
-                                        "category": "CANVAS",
-                                        "tag": str(i),
-                                    }
-                                }
-                            },
-                            "extensions": {},
-                            "operationName": "replace",
-                            "query": "subscription replace($input: SubscribeInput!) {\n  subscribe(input: $input) {\n    id\n    ... on BasicMessage {\n      data {\n        __typename\n        ... on FullFrameMessageData {\n          __typename\n          name\n          timestamp\n        }\n        ... on DiffFrameMessageData {\n          __typename\n          name\n          currentTimestamp\n          previousTimestamp\n        }\n      }\n      __typename\n    }\n    __typename\n  }\n}\n",
-                        },
-                    }
-                )
+            completion = CompletionTracker(self.template_sparse, origin, self.completion_regions)
+            # hold the mirror lock so no diff lands between the snapshot and the
+            # rebuild, and until both are installed: diffs composited later reach
+            # them through on_board_change. Palette listeners run under this lock
+            # too, so the palette cannot change between the check and the install.
+            with self.board_mirror.lock:
+                index.rebuild(self.board_mirror.view(*region), *origin)
+                completion.rebuild(self.board_mirror.view(*region), *origin)
+                if self.palette.hash != palette_hash:
+                    # built from a template quantized for the old palette; the next pick resyncs
+                    logger.info("Palette changed during the board sync, discarding the index")
+                    return
+                self.mismatch_index = index
+                self.completion = completion
+            logger.info(
+                "{} of {} template pixels need fixing", len(index), len(index.sparse)
             )
 
-        imgs = []
-        logger.debug("A total of {} canvas sockets opened", len(canvas_sockets))
-
-
-        
-        while len(canvas_sockets) > 0:
-            temp = json.loads(ws.recv())
-            logger.debug("Waiting for WebSocket message")
-
-            if temp["type"] == "data":
-                logger.debug("Received WebSocket data type message")
-                msg = temp["payload"]["data"]["subscribe"]
-
-                if msg["data"]["__typename"] == "FullFrameMessageData":
-                    logger.debug("Received full frame message")
-                    img_id = int(temp["id"])
-                    logger.debug("Image ID: {}", img_id)
-
-                    if img_id in canvas_sockets:
-                        logger.debug("Getting image: {}", msg["data"]["name"])
-                        imgs.append(
-                            [
-                                img_id,
-                                Image.open(
-                                    BytesIO(
-                                        requests.get(
-                                            msg["data"]["name"],
-                                            stream=True,
-                                        ).content
-                                    )
-                                ),
-                            ]
-                        )
-                        canvas_sockets.remove(img_id)
-                        logger.debug(
-                            "Canvas sockets remaining: {}", len(canvas_sockets)
-                        )
-
-        for i in range(0, canvas_count - 1):
-            ws.send(json.dumps({"id": str(2 + i), "type": "stop"}))
-
-        ws.close()
-
-        new_img_width = (
-            max(map(lambda x: x["dx"], canvas_details["canvasConfigurations"]))
-            + canvas_details["canvasWidth"]
-        )
-        logger.debug("New image width: {}", new_img_width)
+            shape = self.template_indices.shape
+            contention = self.contention
+            if contention is None or (contention.origin, contention.shape) != (origin, shape):
+                self.contention = ContentionTracker(origin, shape)
+
+    def get_lookup_table(self, palette):
+        if palette.hash not in self.lookup_tables:
+            self.lookup_tables[palette.hash] = palette.load_lookup_table(self.cache_dir)
+        return self.lookup_tables[palette.hash]
+
+    def on_palette_change(self, palette):
+        if palette == self.palette:
+            return
+        logger.warning("Palette changed, re-quantizing the template")
+        self.palette = palette
+        # forces the next pixel pick to sync against the new palette
+        self.mismatch_index = None
+
+    def on_board_change(self, left, top, changed, diff=False):
+        contention = self.contention
+        if diff and contention is not None:
+            contention.record(left, top, changed)
+
+        height, width = changed.shape
+        completion = self.completion
+        if completion is not None:
+            completion.update(
+                left, top, self.board_mirror.view(left, top, width, height), changed
+            )
 
-        new_img_height = (
-            max(map(lambda x: x["dy"], canvas_details["canvasConfigurations"]))
-            + canvas_details["canvasHeight"]
+        index = self.mismatch_index
+        if index is None:
+            return
+        index.update(
+            left, top, self.board_mirror.view(left, top, width, height), changed
         )
-        logger.debug("New image height: {}", new_img_height)
 
-        new_img = Image.new("RGB", (new_img_width, new_img_height))
-
-        for idx, img in enumerate(sorted(imgs, key=lambda x: x[0])):
-            logger.debug("Adding image (ID {}): {}", img[0], img[1])
-            dx_offset = int(canvas_details["canvasConfigurations"][idx]["dx"])
-            dy_offset = int(canvas_details["canvasConfigurations"][idx]["dy"])
-            new_img.paste(img[1], (dx_offset, dy_offset))
-
-        return new_img
+    def completion_stats(self):
+        """Correct, wrong and transparent pixel counts per region, or None before the first sync."""
+        completion = self.completion
+        return completion.stats() if completion is not None else None
 
     def get_unset_pixel(self):
-        originalX = x = random.randint(0, self.image_size[0]-1)
-        originalY = y = random.randint(0, self.image_size[1]-1)
-        loopedOnce = False
-        imgOutdated = True
-
         while True:
-            if x >= self.image_size[0]:
-                y += 1
-                x = 0
-
-            if y >= self.image_size[1]:
-                y = 0
-
-            if x == originalX and y == originalY and loopedOnce:
-                logger.info(
-                    "All pixels correct, trying again in 10 seconds... ",
-                )
-                time.sleep(10)
-                imgOutdated = True
-
-
-            if imgOutdated:
+            if self.mismatch_index is None:
                 try:
-                    boarding = self.get_board(self.access_token)
-                    pix2 = boarding.convert("RGB").load()
-                except Exception:
-                    if not loopedOnce:
-                        pass
-                    else:
-                        logger.info("Couldnt get board, retrying in 10 seconds")
-                        time.sleep(10)
-                        x = originalX
-                        y = originalY
-                        continue
-                imgOutdated = False
-
-            logger.debug("{}, {}", x + self.pixel_x_start, y + self.pixel_y_start)
-            logger.debug(
-                "{}, {}, boarding, {}, {}", x, y, self.image_size[0], self.image_size[1]
-            )
-
-            target_rgb = self.pix[x, y]
-
-            new_rgb = ColorMapper.closest_color(
-                target_rgb, self.rgb_colors_array, self.legacy_transparency
-            )
-
-            if pix2[x + self.pixel_x_start, y + self.pixel_y_start] != new_rgb:
-                logger.debug(
-                    "{}, {}, {}, {}",
-                    pix2[x + self.pixel_x_start, y + self.pixel_y_start],
-                    new_rgb,
-                    new_rgb != (69, 42, 0),
-                    pix2[x, y] != new_rgb,
+                    self.sync_board()
+                except Exception as e:
+                    logger.info("Couldnt get board, retrying in 10 seconds: {}", e)
+                    time.sleep(10)
+                    continue
+
+            # the board mirror may drop the index (palette change) at any time
+            index = self.mismatch_index
+            if index is None:
+                continue
+            with self.metrics.time("pixel_selection"):
+                pixel = index.pick(
+                    self.contention.score if self.contention else None,
+                    self.contention_samples,
                 )
-
-                # (69, 42, 0) is a special color reserved for transparency.
-                if new_rgb != (69, 42, 0):
-                    logger.debug(
-                        "Replacing {} pixel at: {},{} with {} color",
-                        pix2[x + self.pixel_x_start, y + self.pixel_y_start],
-                        x + self.pixel_x_start,
-                        y + self.pixel_y_start,
-                        new_rgb,
-                    )
-                    break
-                else:
-                    logger.info(
-                        "Transparent Pixel at {}, {} skipped",
-                        x + self.pixel_x_start,
-                        y + self.pixel_y_start,
-                    )
-            x += 1
-            loopedOnce = True
-        return x, y, new_rgb
+            if pixel is not None:
+                break
+            logger.info(
+                "All pixels correct, trying again in 10 seconds... ",
+            )
+            time.sleep(10)
+            self.mismatch_index = None
+
+        x, y = pixel
+        color_index = int(index.template[y, x])
+        logger.opt(lazy=True).debug(
+            "Replacing pixel at: {},{} with {} color",
+            lambda: x + self.pixel_x_start,
+            lambda: y + self.pixel_y_start,
+            lambda: self.palette.describe(color_index),
+        )
+        return x, y, color_index
 
 
     def task(self, name, passw):
         self.name = name
         self.passw = passw
-        repeat_forever = True
+
+        # Token refresh, placements and board resyncs (which also watch the
+        # template) are deadline events run as separate tasks, so a slow login or
+        # template download never holds up a placement that is due.
+        self.scheduler = Engine()
+        self.scheduler.schedule_in(0, "token", self.refresh_access_token)
+        self.scheduler.schedule_in(0, "place", self.place_pixel)
+        self.scheduler.schedule_in(self.board_resync_interval, "resync", self.resync_board)
+        self.scheduler.run()
+
+    def refresh_access_token(self):
+        with self.metrics.time("token_refresh"):
+            self._refresh_access_token()
+
+    def _refresh_access_token(self):
+        name = self.name
+        current_timestamp = math.floor(time.time())
+        logger.info(
+            "User {}: Refreshing access token", name
+        )
+
+        username = name
+        password = self.passw
         while True:
-            # Timing shit
-            pixel_place_frequency = 315 + random.random()*60
-
-            current_time = math.floor(time.time())
-            next_placement_time = current_time + pixel_place_frequency
-            if self.access_token is None:
-                next_placement_time = current_time
-
-            while True:
-                current_timestamp = math.floor(time.time())
-                if self.access_token_expiry_timestamp is None or current_timestamp >= self.access_token_expiry_timestamp:
-                    logger.info(
-                        "User {}: Refreshing access token", name
-                    )
+            try:
+                client = requests.Session()
 
-                    username = name
-                    password = passw
-                    while True:
-                        try:
-                            client = requests.Session()
-
-                            client.headers.update(
-                                {
-                                        "User-Agent": f"{utils.select_user_agent(self)}",
-                                        "Origin": "https://www.reddit.com/",
-                                        "Sec-Fetch-Dest": "empty",
-                                        "Sec-Fetch-Mode": "cors",
-                                        "Sec-Fetch-Site": "same-origin"
-                                    }
-                                )
-
-                            r = client.get(
-                                "https://www.reddit.com/login",
-                            )
-                            login_get_soup = BeautifulSoup(r.content, "html.parser")
-                            csrf_token = login_get_soup.find(
-                                "input", {"name": "csrf_token"}
-                            )["value"]
-                            data = {
-                                "username": username,
-                                "password": password,
-                                "dest": "https://new.reddit.com/",
-                                "csrf_token": csrf_token,
-                            }
-
-                            r = client.post(
-                                "https://www.reddit.com/login",
-                                data=data,
-                            )
-                            break
-                        except Exception as e:
-                            logger.error(e)
-                            logger.error(
-                                "Failed to connect to websocket, trying again in 30 seconds..."
-                            )
-                            time.sleep(30)
-                    if r.status_code != HTTPStatus.OK.value:
-                        # password is probably invalid
-                        logger.exception("{} - Authorization failed!", username)
-                        logger.debug("response: {} - {}", r.status_code, r.text)
-                        time.sleep(3)
-                        return
-                    else:
-                        logger.success("{} - Authorization successful!", username)
-                    logger.info("Obtaining access token...")
-                    r = client.get(
-                        "https://new.reddit.com/",
-                    )
-                    data_str = (
-                        BeautifulSoup(r.content, features="html.parser")
-                        .find("script", {"id": "data"})
-                        .contents[0][len("window.__r = ") : -1]
-                    )
-                    data = json.loads(data_str)
-                    response_data = data["user"]["session"]
-
-                    if "error" in response_data:
-                        logger.info(
-                            "An error occured. Make sure you have the correct credentials. Response data: {}",
-                            response_data,
-                        )
-                        time.sleep(3)
-                        exit()
-
-                    self.access_token = response_data["accessToken"]
-                    access_token_expires_in_seconds = response_data[
-                        "expiresIn"
-                    ]  # this is usually "3600"
-
-                    self.access_token_expiry_timestamp = current_timestamp + int(access_token_expires_in_seconds)
-                    logger.info(
-                        "Received new access token: {}************",
-                        self.access_token,
+                client.headers.update(
+                    {
+                            "User-Agent": f"{utils.select_user_agent(self)}",
+                            "Origin": "https://www.reddit.com/",
+                            "Sec-Fetch-Dest": "empty",
+                            "Sec-Fetch-Mode": "cors",
+                            "Sec-Fetch-Site": "same-origin"
+                        }
                     )
 
-                if self.access_token is not None and (
-                    current_timestamp >= next_placement_time
-                ):
-                    current_x, current_y, new_rgb = self.get_unset_pixel() 
-                    new_rgb_hex = ColorMapper.rgb_to_hex(new_rgb)
-                    pixel_color_index = ColorMapper.COLOR_MAP[new_rgb_hex]
-                        
-                    canvas = 0
-                    pixel_x_start = self.pixel_x_start + current_x
-                    pixel_y_start = self.pixel_y_start + current_y
-                    while pixel_x_start > 999:
-                        pixel_x_start -= 1000
-                        canvas += 1
-                    while pixel_y_start > 999:
-                        pixel_y_start -= 1000
-                        canvas += 3
-
-                    # draw the pixel onto r/place
-                    next_placement_time = self.set_pixel_and_check_ratelimit(
-                        self.access_token,
-                        pixel_x_start,
-                        pixel_y_start,
-                        name,
-                        pixel_color_index,
-                        canvas,
-                    )
+                r = client.get(
+                    self.reddit_login_url,
+                )
+                login_get_soup = BeautifulSoup(r.content, "html.parser")
+                csrf_token = login_get_soup.find(
+                    "input", {"name": "csrf_token"}
+                )["value"]
+                data = {
+                    "username": username,
+                    "password": password,
+                    "dest": "https://new.reddit.com/",
+                    "csrf_token": csrf_token,
+                }
 
-                time_until_next_draw = next_placement_time - current_timestamp
+                r = client.post(
+                    self.reddit_login_url,
+                    data=data,
+                )
+                break
+            except Exception as e:
+                logger.error(e)
+                logger.error(
+                    "Failed to connect to websocket, trying again in 30 seconds..."
+                )
+                time.sleep(30)
+        if r.status_code != HTTPStatus.OK.value:
+            # password is probably invalid
+            logger.exception("{} - Authorization failed!", username)
+            logger.debug("response: {} - {}", r.status_code, r.text)
+            time.sleep(3)
+            self.scheduler.stop()
+            return
+        else:
+            logger.success("{} - Authorization successful!", username)
+        logger.info("Obtaining access token...")
+        r = client.get(
+            self.reddit_session_url,
+        )
+        data_str = (
+            BeautifulSoup(r.content, features="html.parser")
+            .find("script", {"id": "data"})
+            .contents[0][len("window.__r = ") : -1]
+        )
+        data = json.loads(data_str)
+        response_data = data["user"]["session"]
+
+        if "error" in response_data:
+            logger.info(
+                "An error occured. Make sure you have the correct credentials. Response data: {}",
+                response_data,
+            )
+            time.sleep(3)
+            exit()
+
+        self.access_token = response_data["accessToken"]
+        access_token_expires_in_seconds = response_data[
+            "expiresIn"
+        ]  # this is usually "3600"
+
+        self.access_token_expiry_timestamp = current_timestamp + int(access_token_expires_in_seconds)
+        logger.info(
+            "Received new access token: {}************",
+            self.access_token,
+        )
+        self.scheduler.schedule(
+            self.access_token_expiry_timestamp, "token", self.refresh_access_token
+        )
+
+    def place_pixel(self):
+        if self.access_token is None:
+            # the first token refresh runs alongside; wait for it
+            self.scheduler.schedule_in(1, "place", self.place_pixel)
+            return
+        next_placement_time = self.place_cycle()
+        if next_placement_time is not None:
+            self.scheduler.schedule(next_placement_time, "place", self.place_pixel)
+
+    def place_cycle(self):
+        """Pick a wrong pixel and place it; returns when the next placement is due, or None to stop."""
+        current_x, current_y, pixel_color_index = self.get_unset_pixel()
+
+        canvas, pixel_x_start, pixel_y_start = self.board_mirror.geometry.to_canvas(
+            self.pixel_x_start + current_x, self.pixel_y_start + current_y
+        )
 
-                # If next_pixel_placement_time (returned by place_pixel_and_check_ratelimit)
-                # is too large, user is likely permabanned
-                if time_until_next_draw > 10000:
-                    logger.warning(
-                        "CANCELLED :: Rate-Limit Banned"
-                    )   
-                    repeat_forever = False
-                    time.sleep(5)
-                    break
+        # draw the pixel onto r/place
+        next_placement_time = self.set_pixel_and_check_ratelimit(
+            self.access_token,
+            pixel_x_start,
+            pixel_y_start,
+            self.name,
+            pixel_color_index,
+            canvas,
+        )
 
-                print(f"Time until next place: {time_until_next_draw}", end='\r', flush=True)
+        time_until_next_draw = next_placement_time - math.floor(time.time())
 
+        # If next_pixel_placement_time (returned by place_pixel_and_check_ratelimit)
+        # is too large, user is likely permabanned
+        if time_until_next_draw > 10000:
+            logger.warning(
+                "CANCELLED :: Rate-Limit Banned"
+            )
+            time.sleep(5)
+            self.scheduler.stop()
+            return None
+
+        logger.info("Time until next place: {}", max(time_until_next_draw, 0))
+        self.write_metrics()
+        return next_placement_time
+
+    def resync_board(self):
+        try:
+            self.sync_board()
+        except Exception as e:
+            logger.info("Couldnt resync board: {}", e)
+        if self.board_mirror is not None and self.board_mirror.save_snapshot():
+            logger.debug("Saved board snapshot")
+        if self.contention is not None:
+            logger.debug("Contention: {}", self.contention.summary())
+            if self.contention_heatmap_path:
+                self.contention.export_heatmap(self.contention_heatmap_path)
+        stats = self.completion_stats()
+        if stats is not None:
+            overall = stats["regions"]["overall"]
+            logger.info(
+                "Template {}% done ({} wrong; {} pixels lost, {} gained)",
+                overall["percent"],
+                overall["wrong"],
+                stats["lost"],
+                stats["gained"],
+            )
+            for name, counts in stats["regions"].items():
+                for state in ("correct", "wrong", "transparent"):
+                    self.metrics.gauge(TEMPLATE_PIXELS, counts[state], region=name, state=state)
+            if self.completion_export_path:
+                self.completion.export(self.completion_export_path)
+        self.write_metrics()
+        self.scheduler.schedule_in(
+            self.board_resync_interval, "resync", self.resync_board
+        )
 
-            if not repeat_forever:
-                break 
+    def write_metrics(self):
+        if self.metrics_textfile:
+            self.metrics.write_textfile(self.metrics_textfile)
 
     ## TODO: Add a POST/ping request to the server as an "I'm here!" ping so we can
     ##       know how many instances are running.
     ##       The server is not currently set up to do this.
     def update_image(self):
-        json_response = requests.get("https://us0.co/config.json")
-        if json_response.status_code == 200: #CHECK STATUS OF URL
+        """Refresh the template from the server and return whether it changed.
+
+        Checks at most once per template_refresh_interval and revalidates with
+        ETag / If-Modified-Since. An image that hashes the same as the current
+        template is not written, so callers can skip decoding and quantizing it.
+        """
+        now = time.time()
+        if (
+            self.template_checked_at is not None
+            and now - self.template_checked_at < self.template_refresh_interval
+        ):
+            return False
+        self.template_checked_at = now
+
+        json_response = net.conditional_get(
+            self.template_session, self.template_base_url + "/config.json", self.template_validators
+        )
+        if json_response is None:
+            logger.debug("Template config not modified")
+        elif json_response.status_code == 200: #CHECK STATUS OF URL
             try:
                 self.json_data = json_response.json() #PARSE JSON RESPONSE
 
@@ -525,24 +554,85 @@ class PlaceClient:
         else:
             print("Failed to fetch data. Status code:", json_response.status_code)
 
-        image_response = requests.get("https://us0.co/image.png")
-        if image_response.status_code == 200:
-            filename = 'image.png'
-            image_save_path = os.path.join("./", filename) #SET SAVE PATH
+        image_response = net.conditional_get(
+            self.template_session, self.template_base_url + "/image.png", self.template_validators
+        )
+        if image_response is None:
+            logger.debug("Template image not modified")
+            return False
+        if image_response.status_code != 200:
+            print(f"Failed to download image. Status code: {image_response.status_code}")
+            return False
+
+        image_hash = hashlib.sha256(image_response.content).hexdigest()
+        if image_hash == self.template_hash:
+            logger.debug("Template image unchanged")
+            return False
 
-            #SAVE IMAGE TO PATH
-            with open(image_save_path, 'wb') as f:
-                f.write(image_response.content)
+        #SAVE IMAGE TO PATH
+        with open(self.template_save_path, 'wb') as f:
+            f.write(image_response.content)
+        self.template_hash = image_hash
 
-            print(f"Image saved successfully to {image_save_path}")
-        else:
-            print(f"Failed to download image. Status code: {image_response.status_code}")
+        print(f"Image saved successfully to {self.template_save_path}")
+        return True
+
+
+def compile_template(args):
+    json_data = utils.get_json_data(None, args.config)
+    image_path = args.image or json_data.get("image_path", "images/image.png")
+    out_path = args.out or json_data.get("template_artifact_path", template.artifact_path(image_path))
+    palette = Palette.default()
+    template.compile_template(
+        image_path,
+        json_data["image_start_coords"],
+        palette,
+        lookup_table=palette.load_lookup_table(json_data.get("cache_dir", ".cache")),
+        out_path=out_path,
+    )
+    logger.info("Compiled {} to {}", image_path, out_path)
 
 
 def main():
-    logger.remove()
-    logger.add(sys.stderr, level="INFO")
-    client = PlaceClient('config.json')
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    compile_parser = subparsers.add_parser(
+        "compile-template", help="quantize the template image once, for fast startup"
+    )
+    compile_parser.add_argument("--config", default="config.json")
+    compile_parser.add_argument("--image", help="defaults to image_path from the config")
+    compile_parser.add_argument("--out", help="defaults to the image path with a .tmpl extension")
+    parser.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="profile startup and the chosen placement cycles (cProfile + tracemalloc) into DIR",
+    )
+    parser.add_argument(
+        "--profile-cycles",
+        default="1,2,3",
+        help="comma separated placement cycles to profile, 1 is the first (default 1,2,3)",
+    )
+    args = parser.parse_args()
+
+    # the last AFIP_LOG_RING debug records are kept in memory and only printed
+    # when an error is logged; AFIP_LOG_RING=0 turns this off
+    logs.setup(
+        os.environ.get("AFIP_LOG_LEVEL", "INFO"),
+        int(os.environ.get("AFIP_LOG_RING", 2000)),
+    )
+    if args.command == "compile-template":
+        compile_template(args)
+        return
+
+    if args.profile:
+        profiler = CycleProfiler(
+            args.profile, [int(cycle) for cycle in args.profile_cycles.split(",")]
+        )
+        # startup decodes and quantizes the template (utils.load_image)
+        client = profiler.profile("startup", PlaceClient, 'config.json')
+        client.place_cycle = profiler.wrap("place", client.place_cycle)
+    else:
+        client = PlaceClient('config.json')
     if ('AFIP_USER' in os.environ):
         user = os.environ['AFIP_USER']
     else: 
@@ -554,4 +644,6 @@ def main():
     client.task(user, passw)
         
 if __name__ == "__main__":
+    # frame decoding workers are spawned from the bundled executable too
+    multiprocessing.freeze_support()
     main()
@@ -1,14 +1,20 @@
 # -*- mode: python ; coding: utf-8 -*-
 
 
+import os
+
 block_cipher = None
 
+# ship the compiled template (python main.py compile-template) instead of the
+# image when there is one, so the bundled client starts without image processing
+template_data = [('image.tmpl', '.')] if os.path.exists('image.tmpl') else [('image.png', '.')]
+
 
 a = Analysis(
     ['main.py'],
     pathex=[],
     binaries=[],
-    datas=[('image.png', '.'), ('config.json', '.')],
+    datas=template_data + [('config.json', '.')],
 #    hiddenimports=[certifi, charset-normalizer, idna, python-dotenv, requests, urllib3, Pillow, websocket-client, loguru, beautifulsoup4, stem],
     hookspath=[],
     hooksconfig={},
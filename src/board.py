@@ -0,0 +1,448 @@
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from loguru import logger
+from websocket import create_connection  # type: ignore
+from websocket._exceptions import WebSocketTimeoutException  # type: ignore
+
+from src import logs, net, snapshot, transport
+from src.decode import FramePool, decode_frame
+from src.geometry import CanvasGeometry
+from src.mappings import Palette
+from src.metrics import Metrics
+
+WS_URL = "wss://gql-realtime-2.reddit.com/query"
+WS_ORIGIN = "https://garlic-bread.reddit.com"
+
+# subscription ids: "1" is the configuration, canvas n is subscribed as "2 + n"
+CONFIG_SUBSCRIPTION_ID = "1"
+CANVAS_SUBSCRIPTION_OFFSET = 2
+
+
+class BoardMirror:
+    """In-memory copy of the board kept current by one long-lived websocket.
+
+    Full frames are downloaded once per canvas subscription; after that the
+    DiffFrameMessageData frames from the replace subscription are applied in place.
+    When a diff's previousTimestamp does not match the last frame we applied the
+    canvas is resubscribed to get a fresh full frame. Dropped connections are
+    reconnected and resynced the same way.
+
+    With a region (left, top, width, height) in board coordinates only the canvas
+    tiles it overlaps are subscribed, and only that rectangle is kept in memory.
+
+    Frame images are downloaded on a small thread pool over one keep-alive
+    session while the receive loop keeps reading, and decoded on those threads
+    or, with frame_processes, in a decode.FramePool. Results are applied
+    strictly in arrival order per canvas, so diffs never land out of sequence.
+    """
+
+    def __init__(
+        self,
+        token_provider,
+        lookup_table_provider,
+        region=None,
+        ws_url=WS_URL,
+        reconnect_delay=30,
+        recv_timeout=60,
+        frame_timeout=30,
+        frame_workers=6,
+        frame_processes=0,
+        metrics=None,
+        capture=None,
+        snapshot_dir=None,
+        snapshot_max_age=300,
+    ):
+        # called on every (re)connect so refreshed access tokens get picked up
+        self.token_provider = token_provider
+        # frames are stored as palette indices, one byte per pixel, mapped through
+        # the lookup table for the palette the configuration subscription announces
+        self.lookup_table_provider = lookup_table_provider
+        self.palette = None
+        self.lookup_table = None
+        self.palette_listeners = []
+        self.region = region
+        self.ws_url = ws_url
+        self.reconnect_delay = reconnect_delay
+        self.recv_timeout = recv_timeout
+        self.frame_timeout = frame_timeout
+        # stage timings: ws_connect, frame_download, frame_decode, composite
+        self.metrics = metrics or Metrics()
+        # optional capture.CaptureLog recording every message and frame image
+        self.capture = capture
+        # with a snapshot_dir the mirrored region is saved there by save_snapshot()
+        # and a snapshot younger than snapshot_max_age seconds is served on start
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_max_age = snapshot_max_age
+
+        self.canvas_details = None
+        self.geometry = None
+        self.tiles = []  # canvas indices overlapping the region
+        self.timestamps = {}  # canvas index -> timestamp of the last applied frame
+        self.origin = (0, 0)  # board coordinates of board[0, 0]
+        self.board = None  # (height, width) uint8 palette indices of the region, [y, x]
+        self._reconfigure = False
+
+        self.session = net.make_session(pool_size=frame_workers)
+        self.pool = ThreadPoolExecutor(max_workers=frame_workers, thread_name_prefix="frame")
+        # PNG decoding and the palette lookup, off the GIL of the receive loop
+        self.frame_pool = FramePool(frame_processes) if frame_processes else None
+        # canvas index -> frames waiting to be applied, oldest first
+        self.pending = {}
+        self.loaded = set()  # canvases whose current full frame has been applied
+        self.broken = set()  # canvases that lost a frame and need a resync
+        self.apply_lock = threading.Lock()
+
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.listeners = []
+        # per-frame messages go out at most once per 30 seconds per canvas
+        self.throttle = logs.Throttle(30)
+        self.ws = None
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            if self.snapshot_dir is not None:
+                self._load_snapshot()
+            self.thread = threading.Thread(
+                target=self._run, name="board-mirror", daemon=True
+            )
+            self.thread.start()
+
+    def wait_ready(self, timeout=None):
+        """Block until every canvas has received its full frame, or a fresh snapshot is loaded."""
+        return self.ready.wait(timeout)
+
+    def set_region(self, region):
+        """Mirror a different board rectangle, resubscribing to the tiles it needs."""
+        if region == self.region:
+            return
+        self.region = region
+        self.ready.clear()
+        self._reconfigure = True
+        if self.ws is not None:
+            # wakes the receive loop, which reconnects with the new region
+            self.ws.close()
+
+    def save_snapshot(self):
+        """Write the mirrored region to snapshot_dir, once every canvas has a full frame."""
+        if self.snapshot_dir is None or not self.ready.is_set():
+            return False
+        with self.apply_lock:
+            timestamps = dict(self.timestamps)
+            if not self.loaded.issuperset(self.tiles) or not set(timestamps).issuperset(self.tiles):
+                # still serving a loaded snapshot, or resyncing a canvas
+                return False
+            with self.lock:
+                board = self.board.copy()
+        snapshot.save_snapshot(
+            snapshot.snapshot_path(self.snapshot_dir, self.region),
+            board,
+            self.origin,
+            self.canvas_details,
+            {canvas_index: timestamps[canvas_index] for canvas_index in self.tiles},
+        )
+        return True
+
+    def view(self, left, top, width, height):
+        """The part of the mirrored region inside a board rectangle, without copying.
+
+        Callers that need a consistent picture should hold the lock.
+        """
+        x0, y0 = max(left - self.origin[0], 0), max(top - self.origin[1], 0)
+        return self.board[
+            y0 : max(top - self.origin[1] + height, 0),
+            x0 : max(left - self.origin[0] + width, 0),
+        ]
+
+    def add_listener(self, callback):
+        """Register callback(left, top, changed, diff) for every applied frame.
+
+        changed is a boolean mask of the frame's pixels that were written, placed
+        at (left, top) in board coordinates; diff is False for full frames.
+        """
+        self.listeners.append(callback)
+
+    def add_palette_listener(self, callback):
+        """Register callback(palette) for every palette the server announces.
+
+        Called with the lock held, so nothing holding it sees the palette change.
+        """
+        self.palette_listeners.append(callback)
+
+    def _run(self):
+        while True:
+            try:
+                self._session()
+            except Exception as e:
+                logger.error("Board mirror disconnected: {}", e)
+            finally:
+                if self.ws is not None:
+                    self.ws.close()
+                    self.ws = None
+            self._reset()
+            if self._reconfigure:
+                self._reconfigure = False
+                continue
+            logger.info(
+                "Reconnecting board mirror in {} seconds...", self.reconnect_delay
+            )
+            time.sleep(self.reconnect_delay)
+
+    def _reset(self):
+        # every canvas needs a new full frame after reconnecting
+        self.timestamps.clear()
+        with self.apply_lock:
+            self.pending.clear()
+            self.loaded.clear()
+            self.broken.clear()
+
+    def _session(self):
+        logger.debug("Connecting board mirror")
+        if self.capture is not None:
+            self.capture.connect(self.region)
+        with self.metrics.time("ws_connect"):
+            # frame workers may send resubscribes, so sends must be locked
+            self.ws = create_connection(self.ws_url, origin=WS_ORIGIN, enable_multithread=True)
+            self.ws.settimeout(self.recv_timeout)
+            self._send(transport.connection_init(self.token_provider()))
+            while True:
+                msg = self._recv()
+                if not msg:
+                    raise ConnectionError("Reddit failed to acknowledge connection_init")
+                if msg.startswith('{"type":"connection_ack"}'):
+                    logger.debug("Connected to WebSocket server")
+                    break
+
+        logger.debug("Obtaining Canvas information")
+        self._send(transport.config_start(CONFIG_SUBSCRIPTION_ID))
+        while True:
+            payload = json.loads(self._recv())
+            if payload["type"] == "data" and payload["id"] == CONFIG_SUBSCRIPTION_ID:
+                self._configure(payload["payload"]["data"]["subscribe"]["data"])
+                break
+
+        for canvas_index in self.tiles:
+            self._subscribe(canvas_index)
+        logger.debug("A total of {} canvas sockets opened", len(self.tiles))
+
+        while True:
+            try:
+                msg = self._recv()
+            except WebSocketTimeoutException:
+                raise ConnectionError(
+                    "No board traffic for {} seconds".format(self.recv_timeout)
+                )
+            if not msg:
+                raise ConnectionError("Websocket closed by server")
+            self._handle_message(json.loads(msg))
+
+    def _configure(self, canvas_details):
+        logger.debug("Canvas config: {}", canvas_details)
+        self.canvas_details = canvas_details
+        self.geometry = CanvasGeometry.from_config(canvas_details)
+        left, top, width, height = self.geometry.clip(
+            *(self.region or (0, 0, self.geometry.width, self.geometry.height))
+        )
+        self.tiles = self.geometry.tiles_for_rect(left, top, width, height)
+        if self._update_palette(canvas_details):
+            # anything mirrored so far was mapped with another palette
+            self.ready.clear()
+        with self.lock:
+            if (
+                self.board is None
+                or self.origin != (left, top)
+                or self.board.shape[:2] != (height, width)
+            ):
+                logger.debug("Mirroring {}x{} at {}, {}", width, height, left, top)
+                self.origin = (left, top)
+                self.board = np.zeros((height, width), dtype=np.uint8)
+                self.ready.clear()
+
+    def _load_snapshot(self):
+        # serve the last saved board until the subscriptions deliver full frames
+        saved = snapshot.load_snapshot(snapshot.snapshot_path(self.snapshot_dir, self.region))
+        if saved is None:
+            return
+        board, meta = saved
+        age = snapshot.snapshot_age(meta)
+        if age > self.snapshot_max_age:
+            logger.info("Board snapshot is {:.0f}s old, waiting for full frames", age)
+            return
+        self._configure(meta["canvas_details"])
+        if list(self.origin) != meta["origin"] or self.board.shape != board.shape:
+            return
+        with self.lock:
+            self.board = board
+        self.ready.set()
+        logger.info("Loaded board snapshot from {:.0f}s ago", age)
+
+    def _update_palette(self, canvas_details):
+        # returns whether the palette changed
+        if canvas_details.get("colorPalette"):
+            palette = Palette.from_config(canvas_details["colorPalette"])
+        else:
+            palette = self.palette or Palette.default()
+        if palette == self.palette:
+            return False
+        logger.info("Using a {} color palette ({})", len(palette), palette.hash)
+        self.lookup_table = self.lookup_table_provider(palette)
+        self.palette = palette
+        with self.lock:
+            for listener in self.palette_listeners:
+                listener(palette)
+        return True
+
+    def _subscribe(self, canvas_index):
+        self._send(
+            transport.replace_start(CANVAS_SUBSCRIPTION_OFFSET + canvas_index, canvas_index)
+        )
+
+    def _resubscribe(self, canvas_index):
+        self.timestamps.pop(canvas_index, None)
+        self.broken.discard(canvas_index)
+        self._send(transport.stop(CANVAS_SUBSCRIPTION_OFFSET + canvas_index))
+        self._subscribe(canvas_index)
+
+    def _send(self, message):
+        # messages come pre-serialized from src.transport
+        self.ws.send(message)
+
+    def _recv(self):
+        msg = self.ws.recv()
+        if msg and self.capture is not None:
+            self.capture.message(msg)
+        return msg
+
+    def _handle_message(self, msg):
+        if msg["type"] != "data":
+            return
+        if msg["id"] == CONFIG_SUBSCRIPTION_ID:
+            self._handle_config(msg["payload"]["data"]["subscribe"]["data"])
+            return
+        canvas_index = int(msg["id"]) - CANVAS_SUBSCRIPTION_OFFSET
+        if canvas_index not in self.tiles:
+            return
+        data = msg["payload"]["data"]["subscribe"]["data"]
+
+        if data["__typename"] == "FullFrameMessageData":
+            if self.throttle(("full-frame", canvas_index)) is not None:
+                logger.debug("Full frame for canvas {}: {}", canvas_index, data["name"])
+            self._queue_frame(canvas_index, data["name"], diff=False)
+            self.timestamps[canvas_index] = data["timestamp"]
+
+        elif data["__typename"] == "DiffFrameMessageData":
+            if canvas_index not in self.timestamps:
+                # still waiting for this canvas' full frame
+                return
+            if (
+                canvas_index in self.broken
+                or self.timestamps[canvas_index] != data["previousTimestamp"]
+            ):
+                suppressed = self.throttle(("missed", canvas_index))
+                if suppressed is not None:
+                    logger.warning(
+                        "Missed a diff on canvas {}, resyncing ({} more since the last)",
+                        canvas_index,
+                        suppressed,
+                    )
+                self._resubscribe(canvas_index)
+                return
+            self._queue_frame(canvas_index, data["name"], diff=True)
+            self.timestamps[canvas_index] = data["currentTimestamp"]
+
+    def _handle_config(self, canvas_details):
+        if (
+            "canvasConfigurations" in canvas_details
+            and CanvasGeometry.from_config(canvas_details) != self.geometry
+        ):
+            self._reconfigure = True
+            raise ConnectionError("Canvas layout changed")
+        if self._update_palette(canvas_details):
+            # everything mirrored so far was mapped with the old palette; not
+            # ready again until every tile has a full frame in the new one
+            self.ready.clear()
+            with self.apply_lock:
+                self.loaded.difference_update(self.tiles)
+            for canvas_index in self.tiles:
+                self._resubscribe(canvas_index)
+
+    def _queue_frame(self, canvas_index, url, diff):
+        future = self.pool.submit(self._decode_frame, canvas_index, url, diff)
+        with self.apply_lock:
+            self.pending.setdefault(canvas_index, deque()).append((future, diff))
+        future.add_done_callback(lambda _: self._drain(canvas_index))
+
+    def _drain(self, canvas_index):
+        # apply every finished frame at the head of this canvas' queue, in order
+        with self.apply_lock:
+            queue = self.pending.get(canvas_index)
+            while queue and queue[0][0].done():
+                future, diff = queue.popleft()
+                try:
+                    frame = future.result()
+                except Exception as e:
+                    suppressed = self.throttle(("fetch", canvas_index))
+                    if suppressed is not None:
+                        logger.error(
+                            "Failed to fetch frame for canvas {}: {} ({} more since the last)",
+                            canvas_index,
+                            e,
+                            suppressed,
+                        )
+                    # the diff chain has a hole now; the next diff triggers a resync
+                    self.broken.add(canvas_index)
+                    continue
+                if frame is not None:
+                    self._apply(*frame, diff)
+                if not diff:
+                    self.loaded.add(canvas_index)
+                    if self.loaded.issuperset(self.tiles):
+                        self.ready.set()
+
+    def _fetch_frame(self, url):
+        response = self.session.get(url, timeout=self.frame_timeout)
+        response.raise_for_status()
+        if self.capture is not None:
+            self.capture.frame(url, response.content)
+        return response.content
+
+    def _decode_frame(self, canvas_index, url, diff):
+        """Download a frame and crop it to the mirrored region (runs on the pool).
+
+        Returns (left, top, indices, changed) in board coordinates, or None when
+        the tile does not overlap the region.
+        """
+        with self.metrics.time("frame_download"):
+            content = self._fetch_frame(url)
+        with self.metrics.time("frame_decode"):
+            frame = (
+                content,
+                self.geometry.canvas_offsets[canvas_index],
+                self.origin,
+                self.board.shape[:2],
+                diff,
+                self.lookup_table,
+            )
+            if self.frame_pool is not None:
+                return self.frame_pool.decode(*frame)
+            return decode_frame(*frame)
+
+    def _apply(self, x0, y0, indices, changed, diff):
+        left, top = self.origin
+        height, width = changed.shape
+
+        with self.lock, self.metrics.time("composite"):
+            region = self.board[y0 - top : y0 - top + height, x0 - left : x0 - left + width]
+            if diff:
+                region[changed] = indices[changed]
+            else:
+                region[...] = indices
+
+        for listener in self.listeners:
+            listener(x0, y0, changed, diff)
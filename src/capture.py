@@ -0,0 +1,180 @@
+import json
+import mmap
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from loguru import logger
+
+from src.board import CONFIG_SUBSCRIPTION_ID, BoardMirror
+
+MAGIC = b"PLACECAP1\n"
+# kind, wall clock time, payload length
+HEADER = struct.Struct("<BdI")
+URL_LENGTH = struct.Struct("<H")
+
+CONNECT = 0  # payload: JSON {"region": [left, top, width, height] or null}
+MESSAGE = 1  # payload: the websocket message text, UTF-8
+FRAME = 2  # payload: URL length, URL, then the frame image bytes as downloaded
+
+Record = namedtuple("Record", "kind time offset length")
+
+
+class CaptureLog:
+    """Append-only log of the websocket messages and frame images a board mirror sees.
+
+    Every record is a small fixed header followed by its payload, written in
+    arrival order. Frame images are stored once per URL, exactly as downloaded,
+    so a capture can be replayed with ReplayBoardMirror without any network.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.frame_urls = set()
+
+    def connect(self, region):
+        self._write(CONNECT, json.dumps({"region": region}).encode())
+
+    def message(self, text):
+        self._write(MESSAGE, text.encode())
+
+    def frame(self, url, content):
+        # called from every frame download thread
+        with self.lock:
+            if url in self.frame_urls:
+                return
+            self.frame_urls.add(url)
+        encoded = url.encode()
+        self._write(FRAME, URL_LENGTH.pack(len(encoded)) + encoded + content)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def _write(self, kind, payload):
+        with self.lock:
+            self.file.write(HEADER.pack(kind, time.time(), len(payload)))
+            self.file.write(payload)
+            # one flush per record keeps the log usable after a crash
+            self.file.flush()
+
+
+def read_records(data):
+    """Records of a capture's bytes (or mmap), in order, with payload offsets."""
+    if data[: len(MAGIC)] != MAGIC:
+        raise ValueError("Not a board capture")
+    offset = len(MAGIC)
+    while offset + HEADER.size <= len(data):
+        kind, timestamp, length = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        if offset + length > len(data):
+            # the capturing process died mid-record
+            logger.warning("Capture truncated at byte {}", offset)
+            return
+        yield Record(kind, timestamp, offset, length)
+        offset += length
+
+
+class ReplayBoardMirror(BoardMirror):
+    """Board mirror fed from a CaptureLog instead of a websocket.
+
+    Messages go through the same handling, frame decoding and diff application
+    as live traffic. With speed 1 they are replayed at the pace they were
+    captured, with speed n n times faster, and with speed 0 as fast as possible.
+    Resubscribes cannot be sent anywhere, so a replay sees exactly the frames
+    the capture recorded.
+    """
+
+    def __init__(self, lookup_table_provider, path, region=None, speed=1.0, **kwargs):
+        super().__init__(lambda: "", lookup_table_provider, region, **kwargs)
+        self.path = path
+        self.speed = speed
+        # without a region of its own the replay mirrors what was captured
+        self.use_captured_region = region is None
+        self.finished = threading.Event()
+        self.data = None
+        self.frames = {}  # frame url -> (offset, length) of the image bytes
+        self.messages = 0
+
+    def _run(self):
+        try:
+            self.replay()
+        except Exception as e:
+            logger.exception("Replay failed: {}", e)
+        finally:
+            self.finished.set()
+
+    def replay(self):
+        with open(self.path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        records = list(read_records(self.data))
+        for record in records:
+            if record.kind == FRAME:
+                (url_length,) = URL_LENGTH.unpack_from(self.data, record.offset)
+                start = record.offset + URL_LENGTH.size
+                url = self.data[start : start + url_length].decode()
+                self.frames[url] = (start + url_length, record.length - URL_LENGTH.size - url_length)
+
+        started = time.perf_counter()
+        first = None
+        configured = False
+        for record in records:
+            if record.kind == FRAME:
+                continue
+            if first is None:
+                first = record.time
+            if self.speed:
+                delay = (record.time - first) / self.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+            payload = self.data[record.offset : record.offset + record.length]
+            if record.kind == CONNECT:
+                region = json.loads(payload)["region"]
+                if self.use_captured_region and region is not None:
+                    self.region = tuple(region)
+                # the live mirror reconnected here
+                self._drain_pool()
+                self._reset()
+                configured = False
+                continue
+
+            self.messages += 1
+            msg = json.loads(payload)
+            if msg.get("type") != "data":
+                continue
+            if not configured and msg["id"] == CONFIG_SUBSCRIPTION_ID:
+                self._configure(msg["payload"]["data"]["subscribe"]["data"])
+                configured = True
+                continue
+            try:
+                self._handle_message(msg)
+            except ConnectionError as e:
+                # the live mirror dropped the connection; the capture has its reconnect
+                logger.info("Replayed disconnect: {}", e)
+        self._drain_pool()
+        logger.info(
+            "Replayed {} messages in {:.2f}s", self.messages, time.perf_counter() - started
+        )
+
+    def _drain_pool(self):
+        # wait until every queued frame has been applied, so replays stay in step
+        while True:
+            with self.apply_lock:
+                if not any(self.pending.values()):
+                    return
+            time.sleep(0.001)
+
+    def _send(self, message):
+        pass
+
+    def _fetch_frame(self, url):
+        if url not in self.frames:
+            raise KeyError("Frame was not captured: {}".format(url))
+        offset, length = self.frames[url]
+        return self.data[offset : offset + length]
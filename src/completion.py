@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+
+import numpy as np
+
+from src import utils
+from src.geometry import overlap_slices
+
+
+class CompletionTracker:
+    """Correct, wrong and transparent pixel counts of the template.
+
+    Counted overall and per named region (left, top, width, height in template
+    coordinates). The first count is one vectorized pass over the template's
+    opaque pixels (a SparseTemplate); after that board updates only recheck
+    the pixels they wrote, so keeping the counts costs O(changed pixels).
+    Pixels turning wrong are counted as lost, pixels turning right as gained,
+    which shows how fast the art decays.
+    """
+
+    def __init__(self, sparse, origin, regions=None):
+        self.sparse = sparse
+        self.origin = tuple(origin)  # board coordinates of template pixel (0, 0)
+        self.shape = (sparse.height, sparse.width)
+        self.correct = np.zeros(len(sparse), dtype=bool)  # per owned pixel
+
+        self.regions = {"overall": (0, 0, sparse.width, sparse.height)}
+        self.regions.update({name: tuple(rect) for name, rect in (regions or {}).items()})
+        # region name -> which owned pixels it contains, and its pixel area
+        self.members = {}
+        self.areas = {}
+        for name, (left, top, width, height) in self.regions.items():
+            self.members[name] = (
+                (sparse.xs >= left)
+                & (sparse.xs < left + width)
+                & (sparse.ys >= top)
+                & (sparse.ys < top + height)
+            )
+            x0, y0 = max(left, 0), max(top, 0)
+            x1, y1 = min(left + width, sparse.width), min(top + height, sparse.height)
+            self.areas[name] = max(x1 - x0, 0) * max(y1 - y0, 0)
+        self.counts = {name: 0 for name in self.regions}  # correct pixels per region
+        self.lost = 0
+        self.gained = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def rebuild(self, board_indices, left=0, top=0):
+        """Count from scratch against a board rectangle at (left, top); like MismatchIndex.rebuild."""
+        sparse = self.sparse
+        correct = np.zeros(len(sparse), dtype=bool)
+        overlap = overlap_slices(self.origin, self.shape, left, top, board_indices.shape)
+        if overlap is not None:
+            template_slice, board_slice = overlap
+            positions = sparse.positions(*template_slice)
+            board_ys = sparse.ys[positions] + (board_slice[0].start - template_slice[0].start)
+            board_xs = sparse.xs[positions] + (board_slice[1].start - template_slice[1].start)
+            correct[positions] = board_indices[board_ys, board_xs] == sparse.colors[positions]
+        counts = {
+            name: int(np.count_nonzero(correct & members)) for name, members in self.members.items()
+        }
+        with self.lock:
+            self.correct = correct
+            self.counts = counts
+
+    def update(self, left, top, board_indices, changed):
+        """Recheck the pixels written by a board diff; like MismatchIndex.update."""
+        overlap = overlap_slices(self.origin, self.shape, left, top, changed.shape)
+        if overlap is None:
+            return
+        template_slice, board_slice = overlap
+        ys, xs = np.nonzero(changed[board_slice])
+        if len(ys) == 0:
+            return
+        colors = board_indices[board_slice][ys, xs]
+        offsets = (ys + template_slice[0].start) * self.sparse.width + xs + template_slice[1].start
+
+        # owned pixels among the written ones, as positions into the sparse template
+        positions = np.searchsorted(self.sparse.offsets, offsets)
+        positions[positions == len(self.sparse)] = 0
+        owned = self.sparse.offsets[positions] == offsets if len(self.sparse) else np.zeros(0, bool)
+        positions, colors = positions[owned], colors[owned]
+
+        now_correct = colors == self.sparse.colors[positions]
+        with self.lock:
+            flipped = positions[now_correct != self.correct[positions]]
+            if len(flipped) == 0:
+                return
+            self.correct[flipped] = ~self.correct[flipped]
+            turned_right = self.correct[flipped]
+            self.gained += int(np.count_nonzero(turned_right))
+            self.lost += int(np.count_nonzero(~turned_right))
+            delta = np.where(turned_right, 1, -1)
+            for name, members in self.members.items():
+                inside = members[flipped]
+                if inside.any():
+                    self.counts[name] += int(delta[inside].sum())
+
+    def stats(self):
+        """Counts per region: correct, wrong, transparent and percent done."""
+        regions = {}
+        with self.lock:
+            counts = dict(self.counts)
+            lost, gained = self.lost, self.gained
+        for name in self.regions:
+            owned = int(np.count_nonzero(self.members[name]))
+            correct = counts[name]
+            regions[name] = {
+                "correct": correct,
+                "wrong": owned - correct,
+                "transparent": self.areas[name] - owned,
+                "percent": round(100 * correct / owned, 2) if owned else 100.0,
+            }
+        return {
+            "regions": regions,
+            "lost": lost,
+            "gained": gained,
+            "seconds": round(time.time() - self.started),
+        }
+
+    def export(self, path):
+        with utils.atomic_write(path) as f:
+            json.dump(dict(self.stats(), timestamp=time.time()), f, indent=2)
@@ -0,0 +1,74 @@
+import time
+
+import numpy as np
+from PIL import Image
+
+from src.geometry import overlap_slices
+
+
+class ContentionTracker:
+    """How often, and how recently, each template pixel gets overwritten.
+
+    Fed from the diff frames of the board mirror. Counters are uint16
+    (saturating) and last-change times are uint32 epoch seconds, so a 1000x1000
+    template costs 6MB.
+    """
+
+    MAX_COUNT = np.iinfo(np.uint16).max
+
+    def __init__(self, origin, shape, recent_seconds=120, recent_penalty=8):
+        self.origin = tuple(origin)  # board coordinates of template pixel (0, 0)
+        self.shape = tuple(shape)
+        # a pixel changed within recent_seconds scores like recent_penalty extra overwrites
+        self.recent_seconds = recent_seconds
+        self.recent_penalty = recent_penalty
+
+        self.overwrites = np.zeros(self.shape, dtype=np.uint16)
+        self.last_changed = np.zeros(self.shape, dtype=np.uint32)  # 0 = never seen
+        self.started = time.time()
+
+    def record(self, left, top, changed, now=None):
+        """Count the pixels written by a diff frame at (left, top) in board coordinates."""
+        overlap = overlap_slices(self.origin, self.shape, left, top, changed.shape)
+        if overlap is None:
+            return
+        template_slice, diff_slice = overlap
+        written = changed[diff_slice]
+
+        counts = self.overwrites[template_slice]
+        counts[written] = np.minimum(counts[written].astype(np.uint32) + 1, self.MAX_COUNT)
+        self.last_changed[template_slice][written] = int(now or time.time())
+
+    def score(self, offsets, now=None):
+        """Contention of flat template offsets, lower is more likely to stay placed."""
+        now = int(now or time.time())
+        last_changed = self.last_changed.ravel()[offsets]
+        recent = (last_changed > 0) & (now - last_changed.astype(np.int64) < self.recent_seconds)
+        return self.overwrites.ravel()[offsets].astype(np.uint32) + recent * self.recent_penalty
+
+    def summary(self):
+        hottest = int(np.argmax(self.overwrites))
+        return {
+            "overwrites": int(self.overwrites.sum(dtype=np.uint64)),
+            "contested_pixels": int(np.count_nonzero(self.overwrites)),
+            "hottest_pixel": (hottest % self.shape[1], hottest // self.shape[1]),
+            "hottest_count": int(self.overwrites.ravel()[hottest]),
+            "seconds": round(time.time() - self.started),
+        }
+
+    def export_heatmap(self, path):
+        """Write the overwrite counts as a heatmap PNG and the raw counters next to it (.npz)."""
+        counts = np.log1p(self.overwrites.astype(np.float32))
+        if counts.max() > 0:
+            counts /= counts.max()
+        # black -> red -> yellow -> white
+        heat = np.stack(
+            [np.clip(3 * counts - channel, 0, 1) for channel in range(3)], axis=-1
+        )
+        Image.fromarray((heat * 255).astype(np.uint8)).save(path)
+        np.savez_compressed(
+            path.rsplit(".", 1)[0] + ".npz",
+            overwrites=self.overwrites,
+            last_changed=self.last_changed,
+            origin=np.array(self.origin),
+        )
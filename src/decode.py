@@ -0,0 +1,126 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing import shared_memory
+
+import numpy as np
+from loguru import logger
+from PIL import Image
+
+from src.mappings import ColorMapper
+
+# in worker processes: lookup table path -> memory map, opened once per palette
+_lookup_tables = {}
+
+
+def decode_frame(content, offset, origin, shape, diff, lookup_table):
+    """Decode a PNG frame and crop it to the mirrored region as palette indices.
+
+    offset is the tile's (dx, dy) on the board, origin and shape the mirrored
+    region's top left and (height, width). Returns (left, top, indices, changed)
+    in board coordinates, or None when the tile does not overlap the region.
+    """
+    image = Image.open(BytesIO(content))
+    dx, dy = offset
+    left, top = origin
+    height, width = shape
+
+    # the part of this tile inside the mirrored region, in board coordinates
+    x0, y0 = max(dx, left), max(dy, top)
+    x1 = min(dx + image.width, left + width)
+    y1 = min(dy + image.height, top + height)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    rgba = np.asarray(image.crop((x0 - dx, y0 - dy, x1 - dx, y1 - dy)).convert("RGBA"))
+    if diff:
+        # diff frames are transparent everywhere except the changed pixels
+        changed = rgba[..., 3] > 0
+    else:
+        changed = np.ones(rgba.shape[:2], dtype=bool)
+    return x0, y0, ColorMapper.lookup_rgb(rgba, lookup_table), changed
+
+
+def _decode_shared(content, offset, origin, shape, diff, lookup_table_path, block_name):
+    # runs in a worker: decode into the caller's shared memory block
+    lookup_table = _lookup_tables.get(lookup_table_path)
+    if lookup_table is None:
+        lookup_table = _lookup_tables[lookup_table_path] = np.load(lookup_table_path, mmap_mode="r")
+    frame = decode_frame(content, offset, origin, shape, diff, lookup_table)
+    if frame is None:
+        return None
+    left, top, indices, changed = frame
+    block = shared_memory.SharedMemory(name=block_name)
+    pixels = np.ndarray((2, *indices.shape), dtype=np.uint8, buffer=block.buf)
+    pixels[0] = indices
+    pixels[1] = changed
+    del pixels  # the block cannot be closed while a view exports its buffer
+    block.close()
+    return left, top, indices.shape
+
+
+class FramePool:
+    """decode_frame in worker processes, with the pixels returned through shared memory.
+
+    Workers get the compressed PNG bytes and the path of the memory-mapped
+    lookup table, which every process maps once and shares through the page
+    cache. decode() creates a shared memory block big enough for the whole
+    mirrored region, the worker writes the indices and then the changed mask
+    into it, and decode() copies them out before closing and unlinking the
+    block. The caller holds its handle throughout: on Windows a block is gone
+    once its last handle closes. Decoding, the RGBA conversion and the lookup
+    no longer hold the GIL of the process reading the websocket, and the full
+    frames of several tiles decode on as many cores.
+
+    Workers are spawned rather than forked, since the client forks from a
+    process full of threads. A pool broken by a dying worker is replaced, and
+    the frame that found it broken is decoded in the calling thread.
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.lock = threading.Lock()
+        self.executor = self._start()
+
+    def _start(self):
+        return ProcessPoolExecutor(
+            max_workers=self.processes, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def decode(self, content, offset, origin, shape, diff, lookup_table):
+        """Same as decode_frame, blocking the calling thread until a worker is done."""
+        path = getattr(lookup_table, "filename", None)
+        if path is None:
+            # only a lookup table mapped from a file can be shared with the workers
+            return decode_frame(content, offset, origin, shape, diff, lookup_table)
+        height, width = shape
+        # no crop is larger than the region; pages the worker never writes stay unallocated
+        block = shared_memory.SharedMemory(create=True, size=max(2 * height * width, 1))
+        try:
+            executor = self.executor
+            try:
+                result = executor.submit(
+                    _decode_shared, bytes(content), offset, origin, shape, diff, path, block.name
+                ).result()
+            except BrokenProcessPool:
+                self._restart(executor)
+                return decode_frame(content, offset, origin, shape, diff, lookup_table)
+            if result is None:
+                return None
+            left, top, (height, width) = result
+            shared = np.ndarray((2, height, width), dtype=np.uint8, buffer=block.buf)
+            pixels = shared.copy()
+            del shared
+        finally:
+            block.close()
+            block.unlink()
+        return left, top, pixels[0], pixels[1].view(bool)
+
+    def _restart(self, broken):
+        with self.lock:
+            # every thread waiting on the broken pool gets here; replace it once
+            if self.executor is broken:
+                logger.warning("Frame decoding worker died, restarting the pool")
+                self.executor = self._start()
+                broken.shutdown(wait=False)
@@ -0,0 +1,207 @@
+import bisect
+import random
+import threading
+
+import numpy as np
+
+from src.geometry import overlap_slices
+from src.mappings import ColorMapper
+from src.template import SparseTemplate
+
+
+class _RandomSet:
+    # flat offsets packed at the front of an int32 array, with O(1) add, discard
+    # and random choice. slots, one entry per template pixel and shared by every
+    # set of an index, holds each member's position (-1 for none), so a pixel can
+    # be in at most one set.
+
+    def __init__(self, members, slots):
+        self.members = members
+        self.size = len(members)
+        self.slots = slots
+
+    def __len__(self):
+        return self.size
+
+    def add(self, member):
+        if self.slots[member] >= 0:
+            return False
+        if self.size == len(self.members):
+            members = np.empty(max(2 * self.size, 16), dtype=np.int32)
+            members[: self.size] = self.members[: self.size]
+            self.members = members
+        self.members[self.size] = member
+        self.slots[member] = self.size
+        self.size += 1
+        return True
+
+    def discard(self, member):
+        position = self.slots[member]
+        if position < 0:
+            return False
+        # move the last member into the hole so removal stays O(1)
+        self.size -= 1
+        last = self.members[self.size]
+        self.members[position] = last
+        self.slots[last] = position
+        self.slots[member] = -1
+        return True
+
+    def choice(self):
+        return int(self.members[random.randrange(self.size)])
+
+
+class MismatchIndex:
+    """Template pixels that currently differ from the board, by priority.
+
+    Built with one vectorized comparison of the template's opaque pixels (a
+    SparseTemplate, so transparent pixels cost nothing) against the board,
+    then kept current from board diffs so only the changed pixels are
+    compared again. Wrong pixels are bucketed by their priority level (0-255,
+    higher goes first) and each bucket is an array-backed set, so picking the
+    most important wrong pixel is O(log levels) no matter how close the art is
+    to done. Memory is a few bytes per template pixel, with no Python object
+    per wrong pixel. Pixels of equal priority are picked at random.
+    """
+
+    def __init__(self, template_indices, origin, opaque=None, priorities=None, sparse=None):
+        self.template = template_indices
+        self.origin = tuple(origin)  # board coordinates of template pixel (0, 0)
+        self.height, self.width = template_indices.shape
+        if opaque is None:
+            opaque = template_indices != ColorMapper.TRANSPARENT_INDEX
+        self.opaque = opaque
+        if priorities is None:
+            priorities = np.zeros(template_indices.shape, dtype=np.uint8)
+        self.priorities = priorities
+        if sparse is None:
+            sparse = SparseTemplate(template_indices, opaque, priorities)
+        self.sparse = sparse
+
+        self.lock = threading.Lock()
+        self._buckets = {}  # priority level -> _RandomSet of flat offsets (y * width + x)
+        self._levels = []  # ascending levels with a non-empty bucket
+        self._count = 0
+        # position of every wrong pixel in its bucket, -1 for the right ones
+        self._slots = np.full(self.height * self.width, -1, dtype=np.int32)
+
+    def __len__(self):
+        return self._count
+
+    def matches(self, template_indices, origin, priorities=None):
+        """Whether this index was built for the given template, origin and priorities."""
+        return (
+            tuple(origin) == self.origin
+            and (template_indices is self.template or np.array_equal(template_indices, self.template))
+            and (
+                priorities is None
+                or priorities is self.priorities
+                or np.array_equal(priorities, self.priorities)
+            )
+        )
+
+    def rebuild(self, board_indices, left=0, top=0):
+        """Compare every opaque template pixel against the board in one pass.
+
+        board_indices are palette indices, indexed [y, x], of a board rectangle
+        at (left, top) in board coordinates; by default the full board.
+        """
+        sparse = self.sparse
+        offsets = np.empty(0, dtype=np.int64)
+        levels = np.empty(0, dtype=np.uint8)
+        window = self._window(left, top, board_indices.shape)
+        if window is not None:
+            board_slice, template_slice = window
+            positions = sparse.positions(*template_slice)
+            # template -> board rectangle coordinates
+            board_ys = sparse.ys[positions] + (board_slice[0].start - template_slice[0].start)
+            board_xs = sparse.xs[positions] + (board_slice[1].start - template_slice[1].start)
+            wrong = board_indices[board_ys, board_xs] != sparse.colors[positions]
+            offsets = sparse.offsets[positions[wrong]]
+            levels = sparse.priorities[positions[wrong]]
+
+        # group the wrong offsets by level with one sort instead of a pass per level
+        order = np.argsort(levels, kind="stable")
+        levels, offsets = levels[order], offsets[order].astype(np.int32)
+        starts = np.flatnonzero(np.r_[True, levels[1:] != levels[:-1]]) if len(levels) else []
+        slots = np.full(self.height * self.width, -1, dtype=np.int32)
+        # each offset's position within its level's group
+        sizes = np.diff(np.r_[starts, len(offsets)])
+        slots[offsets] = np.arange(len(offsets), dtype=np.int32) - np.repeat(starts, sizes).astype(np.int32)
+        buckets = {
+            int(levels[start]): _RandomSet(group, slots)
+            for start, group in zip(starts, np.split(offsets, starts[1:]))
+        }
+        with self.lock:
+            self._buckets = buckets
+            self._levels = sorted(buckets)
+            self._count = len(offsets)
+            self._slots = slots
+
+    def update(self, left, top, board_indices, changed):
+        """Recheck only the pixels written by a board diff.
+
+        board_indices are the palette indices of the diff's rectangle at
+        (left, top) in board coordinates and changed masks the pixels it wrote.
+        """
+        window = self._window(left, top, changed.shape)
+        if window is None:
+            return
+        board_slice, template_slice = window
+        ys, xs = np.nonzero(changed[board_slice])
+        if len(ys) == 0:
+            return
+        colors = board_indices[board_slice][ys, xs]
+        ys += template_slice[0].start
+        xs += template_slice[1].start
+        wrong = (colors != self.template[ys, xs]) & self.opaque[ys, xs]
+
+        offsets = ys * self.width + xs
+        levels = self.priorities[ys, xs]
+        with self.lock:
+            for offset, level in zip(offsets[wrong].tolist(), levels[wrong].tolist()):
+                self._add(offset, level)
+            for offset, level in zip(offsets[~wrong].tolist(), levels[~wrong].tolist()):
+                self._discard(offset, level)
+
+    def pick(self, score=None, samples=1):
+        """The most important wrong pixel as template (x, y), or None when the art is done.
+
+        With score(offsets) -> array, up to samples candidates of the top priority
+        are drawn and the lowest scoring one wins.
+        """
+        with self.lock:
+            if not self._levels:
+                return None
+            bucket = self._buckets[self._levels[-1]]
+            candidates = [bucket.choice() for _ in range(samples if score else 1)]
+        offset = candidates[0]
+        if len(candidates) > 1:
+            offset = candidates[int(np.argmin(score(np.array(candidates))))]
+        return offset % self.width, offset // self.width
+
+    def _window(self, left, top, shape):
+        # overlap of the template with a board rectangle of shape at (left, top),
+        # as slices into that rectangle and into the template
+        overlap = overlap_slices(self.origin, self.template.shape, left, top, shape)
+        if overlap is None:
+            return None
+        template_slice, board_slice = overlap
+        return board_slice, template_slice
+
+    def _add(self, offset, level):
+        bucket = self._buckets.get(level)
+        if bucket is None:
+            bucket = self._buckets[level] = _RandomSet(np.empty(0, dtype=np.int32), self._slots)
+        if bucket.add(offset):
+            self._count += 1
+            if len(bucket) == 1:
+                bisect.insort(self._levels, level)
+
+    def _discard(self, offset, level):
+        bucket = self._buckets.get(level)
+        if bucket is not None and bucket.discard(offset):
+            self._count -= 1
+            if not bucket:
+                del self._buckets[level]
+                self._levels.remove(level)
@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+
+class Engine:
+    """Runs named deadline events as cooperating asyncio tasks.
+
+    schedule(deadline, name, callback) runs callback once time.time() reaches
+    deadline. Every pending event is a task sleeping on the event loop until its
+    deadline; the callback then runs on a worker thread, so blocking network
+    and PIL work in one event (a token refresh, a template reload) never
+    delays another that is already due. Events under one name never overlap:
+    scheduling a name that is waiting replaces it, and scheduling it from its
+    own callback queues the next run.
+
+    schedule() and stop() may be called from any thread.
+    """
+
+    def __init__(self, max_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="engine")
+        self._loop = None
+        self._stopped = None
+        self._lock = threading.Lock()
+        self._waiting = {}  # name -> asyncio.Task of events not yet running
+        self._tasks = set()  # every event task, waiting or running
+        self._initial = []  # events scheduled before run()
+
+    def schedule(self, deadline, name, callback):
+        with self._lock:
+            loop = self._loop
+            if loop is None:
+                self._initial.append((deadline, name, callback))
+                return
+        loop.call_soon_threadsafe(self._schedule, deadline, name, callback)
+
+    def schedule_in(self, delay, name, callback):
+        self.schedule(time.time() + delay, name, callback)
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+    def run(self):
+        """Run events as they come due until stopped or nothing is left."""
+        try:
+            asyncio.run(self._main())
+        finally:
+            with self._lock:
+                self._loop = None
+            # callbacks still running finish in the background
+            self.executor.shutdown(wait=False)
+
+    async def _main(self):
+        self._stopped = asyncio.Event()
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            initial, self._initial = self._initial, []
+        for event in initial:
+            self._schedule(*event)
+        if self._tasks:
+            await self._stopped.wait()
+        for task in list(self._tasks):
+            task.cancel()
+
+    def _schedule(self, deadline, name, callback):
+        self._cancel(name)
+        task = asyncio.ensure_future(self._event(deadline, name, callback))
+        self._waiting[name] = task
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _cancel(self, name):
+        task = self._waiting.pop(name, None)
+        if task is not None:
+            task.cancel()
+
+    def _done(self, task):
+        self._tasks.discard(task)
+        if not self._tasks:
+            self._stopped.set()
+
+    async def _event(self, deadline, name, callback):
+        delay = deadline - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # running now, so scheduling this name again must not cancel us
+        if self._waiting.get(name) is asyncio.current_task():
+            del self._waiting[name]
+        logger.debug("Running scheduled event: {}", name)
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, callback)
+        except Exception:
+            logger.exception("Scheduled event {} failed, stopping", name)
+            self._stopped.set()
@@ -0,0 +1,83 @@
+class CanvasGeometry:
+    """Layout of the canvas tiles that make up the board.
+
+    Built from the CONFIG subscription: every canvas index has a (dx, dy) offset
+    on the board and all canvases share canvasWidth x canvasHeight.
+    Board coordinates have (0, 0) at the top left of the combined board.
+    """
+
+    def __init__(self, canvas_offsets, canvas_width, canvas_height):
+        self.canvas_offsets = dict(canvas_offsets)  # canvas index -> (dx, dy)
+        self.canvas_width = canvas_width
+        self.canvas_height = canvas_height
+        self.width = max(dx for dx, _ in self.canvas_offsets.values()) + canvas_width
+        self.height = max(dy for _, dy in self.canvas_offsets.values()) + canvas_height
+
+    @classmethod
+    def from_config(cls, canvas_details):
+        return cls(
+            {
+                int(c["index"]): (int(c["dx"]), int(c["dy"]))
+                for c in canvas_details["canvasConfigurations"]
+            },
+            int(canvas_details["canvasWidth"]),
+            int(canvas_details["canvasHeight"]),
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, CanvasGeometry) and (
+            self.canvas_offsets,
+            self.canvas_width,
+            self.canvas_height,
+        ) == (other.canvas_offsets, other.canvas_width, other.canvas_height)
+
+    def to_canvas(self, x, y):
+        """Board coordinates to (canvas index, x, y) within that canvas."""
+        for canvas_index, (dx, dy) in self.canvas_offsets.items():
+            if dx <= x < dx + self.canvas_width and dy <= y < dy + self.canvas_height:
+                return canvas_index, x - dx, y - dy
+        raise ValueError("({}, {}) is not on any canvas".format(x, y))
+
+    def to_board(self, canvas_index, x, y):
+        """Coordinates within a canvas to board coordinates."""
+        dx, dy = self.canvas_offsets[canvas_index]
+        return x + dx, y + dy
+
+    def to_display(self, x, y):
+        """Board coordinates to the centered coordinates shown on the site."""
+        return x - self.width // 2, y - self.height // 2
+
+    def tiles_for_rect(self, left, top, width, height):
+        """Indices of the canvases that the board rectangle overlaps."""
+        return [
+            canvas_index
+            for canvas_index, (dx, dy) in sorted(self.canvas_offsets.items())
+            if dx < left + width
+            and left < dx + self.canvas_width
+            and dy < top + height
+            and top < dy + self.canvas_height
+        ]
+
+    def clip(self, left, top, width, height):
+        """The board rectangle clipped to the board, as (left, top, width, height)."""
+        x0, y0 = max(left, 0), max(top, 0)
+        x1, y1 = min(left + width, self.width), min(top + height, self.height)
+        return x0, y0, max(x1 - x0, 0), max(y1 - y0, 0)
+
+
+def overlap_slices(origin, shape, left, top, other_shape):
+    """Overlap of two board rectangles given as (left, top) and (height, width).
+
+    Returns (slices into the rectangle at origin, slices into the one at
+    (left, top)), or None if they don't overlap.
+    """
+    ox, oy = origin
+    x0, y0 = max(ox, left), max(oy, top)
+    x1 = min(ox + shape[1], left + other_shape[1])
+    y1 = min(oy + shape[0], top + other_shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return (
+        (slice(y0 - oy, y1 - oy), slice(x0 - ox, x1 - ox)),
+        (slice(y0 - top, y1 - top), slice(x0 - left, x1 - left)),
+    )
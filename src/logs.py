@@ -0,0 +1,94 @@
+import sys
+import threading
+import time
+from collections import deque
+
+from loguru import logger
+
+DUMP_LEVEL = "ERROR"
+FORMAT = "{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | {name}:{function}:{line} - {message}"
+
+
+class RingBuffer:
+    """The most recent log records, kept in memory and written out on errors.
+
+    Installed as a loguru sink for the levels below the printed one, so debug
+    detail is recorded without being printed. The first record at dump_level
+    or above prints everything collected before it, oldest first, then the
+    buffer starts over.
+    """
+
+    def __init__(self, size=2000, stream=None, dump_level=DUMP_LEVEL):
+        self.records = deque(maxlen=size)
+        self.stream = stream or sys.stderr
+        self.dump_level = logger.level(dump_level).no
+        self.lock = threading.Lock()
+
+    def write(self, message):
+        record = message.record
+        if record["level"].no >= self.dump_level:
+            self.dump(record)
+        else:
+            # only the formatted text is kept, not the record with its references
+            with self.lock:
+                self.records.append(str(message))
+
+    def dump(self, record=None):
+        with self.lock:
+            records, self.records = list(self.records), deque(maxlen=self.records.maxlen)
+        if not records:
+            return
+        reason = "before: {}".format(record["message"]) if record is not None else ""
+        self.stream.write("---- last {} log records {} ----\n".format(len(records), reason))
+        self.stream.writelines(records)
+        self.stream.write("---- end of log records ----\n")
+        self.stream.flush()
+
+
+def setup(level="INFO", ring_size=2000):
+    """Log level and above to stderr; with ring_size, keep recent debug records for errors.
+
+    With the ring every debug call builds a full record (some 15 µs), so
+    per-frame and per-pixel debug lines should be throttled. With ring_size 0
+    nothing below level is ever formatted, since loguru skips messages no
+    sink wants.
+    """
+    logger.remove()
+    logger.add(sys.stderr, level=level, format=FORMAT)
+    shown = logger.level(level).no
+    if ring_size and shown > logger.level("DEBUG").no:
+        ring = RingBuffer(ring_size)
+        # records already printed are not kept again; errors trigger the dump
+        logger.add(
+            ring,
+            level="DEBUG",
+            format=FORMAT,
+            filter=lambda record: record["level"].no < shown or record["level"].no >= ring.dump_level,
+        )
+
+
+class Throttle:
+    """Lets a message through at most once per interval per key, counting the rest.
+
+    For per-pixel and per-frame messages that would otherwise flood the log:
+
+        suppressed = throttle("missed-diff")
+        if suppressed is not None:
+            logger.warning("Missed a diff ({} more since)", suppressed)
+    """
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last = {}  # key -> monotonic time of the last message let through
+        self.suppressed = {}  # key -> messages held back since
+
+    def __call__(self, key):
+        """Messages suppressed since the last one if this one may go out, else None."""
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last.get(key, -self.interval) < self.interval:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return None
+            self.last[key] = now
+            return self.suppressed.pop(key, 0)
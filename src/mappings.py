@@ -1,8 +1,22 @@
+import hashlib
 import math
+import os
+import numpy as np
 from PIL import ImageColor
 
+from src import utils
+
 
 class ColorMapper:
+    # (69, 42, 0) / #452A00 is a special color reserved for transparency.
+    TRANSPARENT_RGB = (69, 42, 0)
+    # palette index used in quantized templates for pixels we leave alone
+    TRANSPARENT_INDEX = 255
+    # pixels quantized per chunk, bounds the (pixels x palette) distance matrix
+    QUANTIZE_CHUNK = 1 << 16
+    # one entry per 24-bit rgb value
+    LOOKUP_TABLE_SIZE = 1 << 24
+
     COLOR_MAP = {
         "#6D001A": 0,  # darkest red
         "#BE0039": 1,  # dark red
@@ -114,3 +128,171 @@ class ColorMapper:
             ImageColor.getcolor(color_hex, "RGB")
             for color_hex in list(ColorMapper.COLOR_MAP.keys())
         ]
+
+    @staticmethod
+    def nearest_indices(rgb, rgb_colors_array: list, color_indices=None):
+        """Nearest palette index for every row of an (n, 3) rgb array.
+
+        Indices are positions in rgb_colors_array unless color_indices gives the
+        palette index of each color.
+        """
+        rgb = np.asarray(rgb, dtype=np.float32)
+
+        # |p - c|^2 = |p|^2 - 2 p.c + |c|^2, and |p|^2 is constant per pixel.
+        # All terms stay well below 2**24, so float32 is exact here.
+        palette = np.asarray(rgb_colors_array, dtype=np.float32)
+        palette_t = -2 * palette.T
+        palette_norm = (palette ** 2).sum(axis=1)
+
+        indices = np.empty(rgb.shape[0], dtype=np.uint8)
+        for start in range(0, rgb.shape[0], ColorMapper.QUANTIZE_CHUNK):
+            chunk = rgb[start : start + ColorMapper.QUANTIZE_CHUNK]
+            indices[start : start + len(chunk)] = np.argmin(
+                chunk @ palette_t + palette_norm, axis=1
+            )
+        if color_indices is not None:
+            indices = np.asarray(color_indices, dtype=np.uint8)[indices]
+        return indices
+
+    @staticmethod
+    def quantize_image(
+        rgba,
+        rgb_colors_array: list,
+        legacy_transparency: bool,
+        lookup_table=None,
+        color_indices=None,
+    ):
+        """Map a whole RGBA image to palette indices in one vectorized pass.
+
+        Returns a (height, width) uint8 array indexed [y, x], with
+        TRANSPARENT_INDEX wherever closest_color would return the transparency color.
+        Uses the 24-bit lookup table when one is given instead of distance math.
+        """
+        rgba = np.asarray(rgba)
+        if lookup_table is not None:
+            indices = ColorMapper.lookup_rgb(rgba, lookup_table)
+        else:
+            indices = ColorMapper.nearest_indices(
+                rgba[..., :3].reshape(-1, 3), rgb_colors_array, color_indices
+            ).reshape(rgba.shape[:2])
+
+        # first check is for the alpha channel transparency in ex. png
+        transparent = rgba[..., 3] == 0
+        # second check is for the legacy method of transparency using hex #452A00.
+        if legacy_transparency:
+            transparent |= np.all(rgba[..., :3] == ColorMapper.TRANSPARENT_RGB, axis=-1)
+        indices[transparent] = ColorMapper.TRANSPARENT_INDEX
+        return indices
+
+    @staticmethod
+    def lookup_rgb(rgb, lookup_table):
+        """Palette indices for an (..., 3+) rgb array via the 24-bit lookup table."""
+        rgb = np.asarray(rgb)
+        keys = (
+            (rgb[..., 0].astype(np.uint32) << 16)
+            | (rgb[..., 1].astype(np.uint32) << 8)
+            | rgb[..., 2]
+        )
+        return np.asarray(lookup_table[keys], dtype=np.uint8)
+
+    @staticmethod
+    def palette_hash(rgb_colors_array: list, color_indices=None):
+        """Short stable hash of the palette, used to key cached lookup tables."""
+        palette = np.asarray(rgb_colors_array, dtype=np.uint8)
+        digest = hashlib.sha1(palette.tobytes())
+        if color_indices is not None:
+            digest.update(np.asarray(color_indices, dtype=np.uint8).tobytes())
+        return digest.hexdigest()[:16]
+
+    @staticmethod
+    def build_lookup_table(rgb_colors_array: list, color_indices=None):
+        """Nearest palette index for every possible 24-bit rgb value."""
+        table = np.empty(ColorMapper.LOOKUP_TABLE_SIZE, dtype=np.uint8)
+        step = ColorMapper.QUANTIZE_CHUNK * 16
+        for start in range(0, ColorMapper.LOOKUP_TABLE_SIZE, step):
+            keys = np.arange(start, start + step, dtype=np.uint32)
+            rgb = np.stack(((keys >> 16) & 0xFF, (keys >> 8) & 0xFF, keys & 0xFF), axis=1)
+            table[start : start + step] = ColorMapper.nearest_indices(
+                rgb, rgb_colors_array, color_indices
+            )
+        return table
+
+    @staticmethod
+    def load_lookup_table(rgb_colors_array: list, cache_dir: str, color_indices=None):
+        """Memory-map the cached lookup table for this palette, building it if missing."""
+        path = os.path.join(
+            cache_dir,
+            "palette_lut_{}.npy".format(
+                ColorMapper.palette_hash(rgb_colors_array, color_indices)
+            ),
+        )
+        if not os.path.exists(path):
+            os.makedirs(cache_dir, exist_ok=True)
+            table = ColorMapper.build_lookup_table(rgb_colors_array, color_indices)
+            with utils.atomic_write(path, "wb") as f:
+                np.save(f, table)
+        return np.load(path, mmap_mode="r")
+
+
+class Palette:
+    """The palette in use right now: palette index -> rgb color.
+
+    Starts out as ColorMapper.COLOR_MAP and is replaced by whatever the
+    configuration subscription announces. Indices are the server's color
+    indices, so they can be sent to setPixel as-is even if they are not
+    contiguous.
+    """
+
+    def __init__(self, colors: dict):
+        self.colors = dict(sorted(colors.items()))  # index -> (r, g, b)
+        self.color_indices = list(self.colors.keys())
+        self.rgb_colors_array = list(self.colors.values())
+        self.hash = ColorMapper.palette_hash(self.rgb_colors_array, self.color_indices)
+
+    @classmethod
+    def default(cls):
+        return cls(
+            {
+                color_index: ImageColor.getcolor(color_hex, "RGB")
+                for color_hex, color_index in ColorMapper.COLOR_MAP.items()
+            }
+        )
+
+    @classmethod
+    def from_config(cls, color_palette: dict):
+        """Palette from a ConfigurationMessageData colorPalette."""
+        return cls(
+            {
+                int(color["index"]): ImageColor.getcolor(color["hex"], "RGB")
+                for color in color_palette["colors"]
+            }
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, Palette) and self.hash == other.hash
+
+    def __len__(self):
+        return len(self.colors)
+
+    def describe(self, color_index: int):
+        """Verbose name of a color index, falling back to its hex code."""
+        if color_index not in self.colors:
+            return "Invalid Color ({})".format(color_index)
+        color_hex = ColorMapper.rgb_to_hex(self.colors[color_index])
+        if ColorMapper.COLOR_MAP.get(color_hex) == color_index:
+            return ColorMapper.color_id_to_name(color_index)
+        return "{} ({})".format(color_hex, color_index)
+
+    def load_lookup_table(self, cache_dir: str):
+        return ColorMapper.load_lookup_table(
+            self.rgb_colors_array, cache_dir, self.color_indices
+        )
+
+    def quantize_image(self, rgba, legacy_transparency: bool, lookup_table=None):
+        return ColorMapper.quantize_image(
+            rgba,
+            self.rgb_colors_array,
+            legacy_transparency,
+            lookup_table,
+            self.color_indices,
+        )
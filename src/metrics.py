@@ -0,0 +1,140 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src import utils
+
+# seconds; covers everything from a mismatch pick to a slow frame download
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = "place_stage_seconds"
+PLACEMENTS = "place_placements_total"
+TEMPLATE_PIXELS = "place_template_pixels"
+
+HELP = {
+    STAGE_SECONDS: "Wall time spent per stage of a placement cycle",
+    PLACEMENTS: "Placement attempts by outcome",
+    TEMPLATE_PIXELS: "Template pixels by region and state",
+}
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Stage timings, counters and gauges in the Prometheus text format.
+
+    Histograms, counters and gauges are keyed by metric name and a label tuple, e.g.
+    metrics.time("set_pixel") observes place_stage_seconds{stage="set_pixel"}.
+    Everything is in memory; render() produces the exposition text, which can
+    be served with serve(port) or written with write_textfile(path) for the
+    node exporter textfile collector.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.histograms = {}  # (name, labels) -> _Histogram
+        self.counters = {}  # (name, labels) -> float
+        self.gauges = {}  # (name, labels) -> float
+        self.server = None
+
+    def observe(self, stage, seconds):
+        key = (STAGE_SECONDS, (("stage", stage),))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = _Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        """Observe the wall time of the with block as stage, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def render(self):
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+
+        seen = set()
+        for (name, labels), histogram in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append("# HELP {} {}".format(name, HELP.get(name, name)))
+                lines.append("# TYPE {} histogram".format(name))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(
+                    "{}_bucket{} {}".format(name, _labels(labels + (("le", bound),)), cumulative)
+                )
+            lines.append("{}_sum{} {}".format(name, _labels(labels), histogram.sum))
+            lines.append("{}_count{} {}".format(name, _labels(labels), histogram.count))
+
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for (name, labels), value in values:
+                if name not in seen:
+                    seen.add(name)
+                    lines.append("# HELP {} {}".format(name, HELP.get(name, name)))
+                    lines.append("# TYPE {} {}".format(name, kind))
+                lines.append("{}{} {}".format(name, _labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve render() on http://host:port/metrics from a daemon thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+    def write_textfile(self, path):
+        with utils.atomic_write(path) as f:
+            f.write(self.render())
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, value) for key, value in labels) + "}"
@@ -0,0 +1,46 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# statuses worth retrying; anything else is returned to the caller as-is
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def make_session(pool_size=10, retries=3, backoff=0.5):
+    """Keep-alive requests session with a connection pool and GET retries."""
+    session = requests.Session()
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(["GET"]),
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def conditional_get(session, url, validators, timeout=30):
+    """GET that revalidates against the last ETag / Last-Modified seen for url.
+
+    validators maps url -> cached validator headers and is updated in place.
+    Returns None when the server answers 304 Not Modified, otherwise the response.
+    """
+    headers = {}
+    cached = validators.get(url, {})
+    if "ETag" in cached:
+        headers["If-None-Match"] = cached["ETag"]
+    if "Last-Modified" in cached:
+        headers["If-Modified-Since"] = cached["Last-Modified"]
+
+    response = session.get(url, headers=headers, timeout=timeout)
+    if response.status_code == 304:
+        return None
+    if response.status_code == 200:
+        validators[url] = {
+            key: response.headers[key]
+            for key in ("ETag", "Last-Modified")
+            if key in response.headers
+        }
+    return response
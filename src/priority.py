@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+
+def importance_mask_path(image_path):
+    """Default location of a template's importance mask: image.png -> image.importance.png"""
+    root, _ = os.path.splitext(image_path)
+    return root + ".importance.png"
+
+
+def load_importance_mask(path, size):
+    """Grayscale importance mask as uint8 priorities, brighter goes first.
+
+    Returns None when there is no usable mask of the template's size.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        mask = Image.open(path).convert("L")
+    except UnidentifiedImageError:
+        return None
+    if mask.size != tuple(size):
+        return None
+    return np.asarray(mask, dtype=np.uint8)
+
+
+def edge_weights(template_indices, opaque):
+    """Priority of each opaque pixel from how many of its 4 neighbours differ.
+
+    Outlines and detail (up to 4 differing neighbours) come before flat fill (0).
+    Transparent neighbours and the template border count as different.
+    """
+    padded = np.pad(template_indices, 1, mode="constant", constant_values=255)
+    padded_opaque = np.pad(opaque, 1, mode="constant", constant_values=False)
+    center = padded[1:-1, 1:-1]
+
+    weights = np.zeros(template_indices.shape, dtype=np.uint8)
+    for dy, dx in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+        neighbour = np.s_[1 + dy : padded.shape[0] - 1 + dy, 1 + dx : padded.shape[1] - 1 + dx]
+        weights += (padded[neighbour] != center) | ~padded_opaque[neighbour]
+    weights[~opaque] = 0
+    return weights
+
+
+def template_priorities(template_indices, opaque, mask_path, mode="auto"):
+    """Per-pixel priorities for the mismatch index.
+
+    mode "auto" uses the importance mask when there is one and edge weights
+    otherwise; "random" gives every pixel the same priority.
+    """
+    if mode == "random":
+        return np.zeros(template_indices.shape, dtype=np.uint8)
+    mask = load_importance_mask(mask_path, template_indices.shape[::-1])
+    if mask is not None:
+        return np.where(opaque, mask, 0).astype(np.uint8)
+    return edge_weights(template_indices, opaque)
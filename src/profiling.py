@@ -0,0 +1,95 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+import tracemalloc
+
+from loguru import logger
+
+# functions the reports always break out, whether or not they make the top list
+FOCUS = r"sync_board|get_unset_pixel|load_image|quantize_template"
+
+
+class CycleProfiler:
+    """cProfile and tracemalloc around selected runs of a function.
+
+    wrap(name, fn) counts the calls of fn; the calls numbered in cycles (1 is
+    the first) run under cProfile, with tracemalloc tracing only for their
+    duration. Each profiled cycle writes to out_dir:
+
+    - <name>-<n>.prof: the raw profile, for snakeviz / pstats
+    - <name>-<n>.txt: the top functions by cumulative time, the FOCUS functions
+      and the allocation sites that grew the most during the cycle
+
+    The report is written before the profiled call returns, so fn should not
+    start the next cycle itself, or the two overlap. cProfile only sees the
+    thread the cycle runs on; tracemalloc sees all of them.
+    """
+
+    def __init__(self, out_dir, cycles=(1, 2, 3), top=25, frames=10):
+        self.out_dir = out_dir
+        self.cycles = set(cycles)
+        self.top = top
+        self.frames = frames
+        self.counts = {}  # name -> calls so far
+        self.lock = threading.Lock()
+        os.makedirs(out_dir, exist_ok=True)
+
+    def wrap(self, name, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.lock:
+                cycle = self.counts[name] = self.counts.get(name, 0) + 1
+            if cycle not in self.cycles:
+                return fn(*args, **kwargs)
+            return self.profile("{}-{}".format(name, cycle), fn, *args, **kwargs)
+
+        return wrapper
+
+    def profile(self, label, fn, *args, **kwargs):
+        """Run fn under the profiler once and write its report as label."""
+        tracemalloc.start(self.frames)
+        before = tracemalloc.take_snapshot()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.disable()
+            after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            self._report(label, profiler, before, after)
+
+    def _report(self, label, profiler, before, after):
+        path = os.path.join(self.out_dir, label)
+        profiler.dump_stats(path + ".prof")
+
+        out = io.StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.strip_dirs().sort_stats("cumulative")
+        out.write("==== {}: top {} functions by cumulative time ====\n".format(label, self.top))
+        stats.print_stats(self.top)
+        out.write("==== {}: {} ====\n".format(label, FOCUS))
+        stats.print_stats(FOCUS)
+
+        out.write("==== {}: top {} allocation sites by growth ====\n".format(label, self.top))
+        # leave out what profiling itself allocates
+        filters = [
+            tracemalloc.Filter(False, module.__file__)
+            for module in (tracemalloc, cProfile, pstats, io)
+        ] + [
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ]
+        differences = after.filter_traces(filters).compare_to(
+            before.filter_traces(filters), "lineno"
+        )
+        growth = [difference for difference in differences if difference.size_diff > 0]
+        for difference in growth[: self.top]:
+            out.write("{}\n".format(difference))
+
+        with open(path + ".txt", "w") as f:
+            f.write(out.getvalue())
+        logger.info("Profile of {} written to {}.txt", label, path)
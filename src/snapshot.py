@@ -0,0 +1,61 @@
+import json
+import os
+import time
+
+import numpy as np
+
+from src import utils
+
+
+def snapshot_path(cache_dir, region):
+    """Where the board snapshot for a mirrored region (or the full board) lives."""
+    if region is None:
+        name = "board_full"
+    else:
+        name = "board_{}_{}_{}x{}".format(*region)
+    return os.path.join(cache_dir, name + ".npy")
+
+
+def save_snapshot(path, board, origin, canvas_details, timestamps):
+    """Write a palette-index board and what it was built from next to it (.json).
+
+    timestamps are the frame timestamps (ms) per canvas index the board is current to.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    meta = {
+        "origin": list(origin),
+        "shape": list(board.shape),
+        "canvas_details": canvas_details,
+        "timestamps": {str(k): v for k, v in timestamps.items()},
+        "saved_at": time.time(),
+    }
+    with utils.atomic_write(path, "wb") as f:
+        np.save(f, board)
+    with utils.atomic_write(path.rsplit(".", 1)[0] + ".json") as f:
+        json.dump(meta, f)
+
+
+def load_snapshot(path):
+    """(board, meta) of a saved snapshot, or None if there is none.
+
+    The board is memory-mapped copy-on-write: loading costs nothing up front and
+    writes never reach the file.
+    """
+    meta_path = path.rsplit(".", 1)[0] + ".json"
+    if not (os.path.exists(path) and os.path.exists(meta_path)):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    board = np.load(path, mmap_mode="c")
+    # the two files are replaced one after the other; skip a mismatched pair
+    if list(board.shape) != meta["shape"]:
+        return None
+    meta["timestamps"] = {int(k): v for k, v in meta["timestamps"].items()}
+    return board, meta
+
+
+def snapshot_age(meta, now=None):
+    """Seconds since the oldest canvas frame in the snapshot."""
+    if not meta["timestamps"]:
+        return float("inf")
+    return (now or time.time()) - min(meta["timestamps"].values()) / 1000
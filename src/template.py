@@ -0,0 +1,170 @@
+import hashlib
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image
+
+from src import mappings, utils
+
+MAGIC = b"PLTMPL1\0"
+# width, height, origin x, origin y, opaque pixels, legacy transparency,
+# palette hash (hex), sha256 of the source image
+HEADER = struct.Struct("<8sIIiiIB16s32s")
+HEADER_SIZE = 128  # sections start after the padded header
+
+CompiledTemplate = namedtuple(
+    "CompiledTemplate",
+    "indices opaque coords origin palette_hash source_hash legacy_transparency",
+)
+
+
+def artifact_path(image_path):
+    """Where the compiled template for an image lives: next to it, as .tmpl."""
+    return os.path.splitext(image_path)[0] + ".tmpl"
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _sections(width, height, count):
+    # byte offsets of the indices, the packed opaque mask and the coordinates
+    indices = HEADER_SIZE
+    mask = _align(indices + width * height)
+    coords = _align(mask + (width * height + 7) // 8)
+    return indices, mask, coords, coords + 4 * count
+
+
+def write_template(path, indices, origin, palette_hash, source_hash, legacy_transparency, opaque):
+    """Write quantized template indices and their opaque mask as a compiled template.
+
+    The file is a fixed header followed by the raw uint8 indices, the opaque mask
+    as a bitmask and the sorted flat offsets (y * width + x) of the opaque pixels
+    as uint32, each section 8-byte aligned so it can be memory-mapped as is.
+    """
+    height, width = indices.shape
+    coords = np.flatnonzero(opaque).astype(np.uint32)
+    indices_at, mask_at, coords_at, end = _sections(width, height, len(coords))
+
+    buffer = bytearray(end)
+    HEADER.pack_into(
+        buffer,
+        0,
+        MAGIC,
+        width,
+        height,
+        origin[0],
+        origin[1],
+        len(coords),
+        legacy_transparency,
+        palette_hash.encode(),
+        bytes.fromhex(source_hash),
+    )
+    buffer[indices_at : indices_at + width * height] = np.ascontiguousarray(indices, dtype=np.uint8).tobytes()
+    mask = np.packbits(opaque.ravel()).tobytes()
+    buffer[mask_at : mask_at + len(mask)] = mask
+    buffer[coords_at:end] = coords.astype("<u4").tobytes()
+
+    with utils.atomic_write(path, "wb") as f:
+        f.write(buffer)
+
+
+def load_template(path):
+    """Memory-map a compiled template, or None if there is no valid one at path.
+
+    indices and coords are read-only views of the file; only the opaque mask is
+    unpacked into memory.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(data) < HEADER_SIZE:
+        return None
+    (
+        magic,
+        width,
+        height,
+        origin_x,
+        origin_y,
+        count,
+        legacy_transparency,
+        palette_hash,
+        source_hash,
+    ) = HEADER.unpack_from(data, 0)
+    indices_at, mask_at, coords_at, end = _sections(width, height, count)
+    if magic != MAGIC or len(data) < end:
+        return None
+
+    indices = np.frombuffer(data, np.uint8, width * height, indices_at).reshape(height, width)
+    mask = np.frombuffer(data, np.uint8, (width * height + 7) // 8, mask_at)
+    opaque = np.unpackbits(mask, count=width * height).view(bool).reshape(height, width)
+    coords = np.frombuffer(data, "<u4", count, coords_at)
+    return CompiledTemplate(
+        indices,
+        opaque,
+        coords,
+        (origin_x, origin_y),
+        palette_hash.decode(),
+        source_hash.hex(),
+        bool(legacy_transparency),
+    )
+
+
+def compile_template(image_path, origin, palette, legacy_transparency=True, lookup_table=None, out_path=None):
+    """Quantize an image against palette and write it as a compiled template."""
+    with open(image_path, "rb") as f:
+        content = f.read()
+    source_hash = hashlib.sha256(content).hexdigest()
+    with Image.open(image_path) as im:
+        rgba = np.asarray(im.convert("RGBA"))
+    indices = palette.quantize_image(rgba, legacy_transparency, lookup_table)
+    out_path = out_path or artifact_path(image_path)
+    write_template(
+        out_path,
+        indices,
+        origin,
+        palette.hash,
+        source_hash,
+        legacy_transparency,
+        indices != mappings.ColorMapper.TRANSPARENT_INDEX,
+    )
+    return out_path
+
+
+class SparseTemplate:
+    """The opaque pixels of a template only, in CSR layout.
+
+    offsets are the sorted flat offsets (y * width + x) of the pixels we own,
+    with their colors and priorities alongside; row_starts[y]:row_starts[y + 1]
+    is the slice of row y. Thin or mostly transparent art costs memory and time
+    in proportion to the pixels it actually covers.
+    """
+
+    def __init__(self, indices, opaque, priorities=None, offsets=None):
+        self.height, self.width = indices.shape
+        if offsets is None:
+            offsets = np.flatnonzero(opaque)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.ys, self.xs = np.divmod(self.offsets, self.width)
+        self.colors = indices.ravel()[self.offsets]
+        if priorities is None:
+            self.priorities = np.zeros(len(self.offsets), dtype=np.uint8)
+        else:
+            self.priorities = priorities.ravel()[self.offsets]
+        self.row_starts = np.searchsorted(
+            self.offsets, np.arange(self.height + 1, dtype=np.int64) * self.width
+        )
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def positions(self, rows, cols):
+        """Positions (into offsets) of the owned pixels inside template slices rows, cols."""
+        start, stop = self.row_starts[rows.start], self.row_starts[rows.stop]
+        xs = self.xs[start:stop]
+        inside = (xs >= cols.start) & (xs < cols.stop)
+        return start + np.flatnonzero(inside)
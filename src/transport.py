@@ -0,0 +1,112 @@
+import json
+import math
+from collections import namedtuple
+
+import requests
+from loguru import logger
+
+from src import net
+
+GQL_URL = "https://gql-realtime-2.reddit.com/query"
+
+SET_PIXEL_QUERY = "mutation setPixel($input: ActInput!) {\n  act(input: $input) {\n    data {\n      ... on BasicMessage {\n        id\n        data {\n          ... on GetUserCooldownResponseMessageData {\n            nextAvailablePixelTimestamp\n            __typename\n          }\n          ... on SetPixelResponseMessageData {\n            timestamp\n            __typename\n          }\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n}\n"
+CONFIG_QUERY = "subscription configuration($input: SubscribeInput!) {\n  subscribe(input: $input) {\n    id\n    ... on BasicMessage {\n      data {\n        __typename\n        ... on ConfigurationMessageData {\n          colorPalette {\n            colors {\n              hex\n              index\n              __typename\n            }\n            __typename\n          }\n          canvasConfigurations {\n            index\n            dx\n            dy\n            __typename\n          }\n          canvasWidth\n          canvasHeight\n          __typename\n        }\n      }\n      __typename\n    }\n    __typename\n  }\n}\n"
+REPLACE_QUERY = "subscription replace($input: SubscribeInput!) {\n  subscribe(input: $input) {\n    id\n    ... on BasicMessage {\n      data {\n        __typename\n        ... on FullFrameMessageData {\n          __typename\n          name\n          timestamp\n        }\n        ... on DiffFrameMessageData {\n          __typename\n          name\n          currentTimestamp\n          previousTimestamp\n        }\n      }\n      __typename\n    }\n    __typename\n  }\n}\n"
+
+# Request bodies and websocket messages, serialized once with printf-style
+# holes for the few values that change; filling them in is a string format.
+SET_PIXEL_BODY = (
+    '{"operationName":"setPixel","variables":{"input":{"actionName":"r/replace:set_pixel",'
+    '"PixelMessageData":{"coordinate":{"x":%d,"y":%d},"colorIndex":%d,"canvasIndex":%d}}},'
+    '"query":' + json.dumps(SET_PIXEL_QUERY).replace("%", "%%") + "}"
+)
+CONNECTION_INIT = '{"type":"connection_init","payload":{"Authorization":%s}}'
+CONFIG_START = (
+    '{"id":"%s","type":"start","payload":{"variables":{"input":{"channel":'
+    '{"teamOwner":"GARLICBREAD","category":"CONFIG"}}},"extensions":{},'
+    '"operationName":"configuration","query":' + json.dumps(CONFIG_QUERY).replace("%", "%%") + "}}"
+)
+REPLACE_START = (
+    '{"id":"%s","type":"start","payload":{"variables":{"input":{"channel":'
+    '{"teamOwner":"GARLICBREAD","category":"CANVAS","tag":"%d"}}},"extensions":{},'
+    '"operationName":"replace","query":' + json.dumps(REPLACE_QUERY).replace("%", "%%") + "}}"
+)
+STOP = '{"id":"%s","type":"stop"}'
+
+SET_PIXEL_HEADERS = {
+    "origin": "https://garlic-bread.reddit.com",
+    "referer": "https://garlic-bread.reddit.com/",
+    "apollographql-client-name": "mona-lisa",
+    "Content-Type": "application/json",
+}
+
+# placement outcomes, also used as metric labels
+SUCCESS = "success"
+RATE_LIMITED = "rate_limited"
+BAD_RESPONSE = "bad_response"
+
+# next_available is the epoch time in ms the next pixel may be placed, or None
+PlacementResult = namedtuple("PlacementResult", "outcome next_available data")
+
+
+def connection_init(access_token):
+    return CONNECTION_INIT % json.dumps("Bearer " + access_token)
+
+
+def config_start(subscription_id):
+    return CONFIG_START % subscription_id
+
+
+def replace_start(subscription_id, canvas_index):
+    return REPLACE_START % (subscription_id, canvas_index)
+
+
+def stop(subscription_id):
+    return STOP % subscription_id
+
+
+def parse_set_pixel(content):
+    """The PlacementResult of a setPixel response body, decoded exactly once."""
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return PlacementResult(BAD_RESPONSE, None, None)
+
+    # There are 2 different JSON keys for responses to get the next timestamp.
+    # If we don't get data, it means we've been rate limited.
+    # If we do, a pixel has been successfully placed.
+    try:
+        if data.get("data") is None:
+            next_available = data["errors"][0]["extensions"]["nextAvailablePixelTs"]
+            return PlacementResult(RATE_LIMITED, math.floor(next_available), data)
+        next_available = data["data"]["act"]["data"][0]["data"]["nextAvailablePixelTimestamp"]
+        return PlacementResult(SUCCESS, math.floor(next_available), data)
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return PlacementResult(BAD_RESPONSE, None, data)
+
+
+class Transport:
+    """GraphQL requests over one persistent keep-alive session.
+
+    timeout is a requests (connect, read) timeout in seconds. setPixel is never
+    retried here: a repeated mutation could place twice, so the caller decides.
+    """
+
+    def __init__(self, gql_url=GQL_URL, timeout=(5, 15)):
+        self.gql_url = gql_url
+        self.timeout = timeout
+        self.session = net.make_session(pool_size=2)
+
+    def set_pixel(self, access_token, x, y, color_index, canvas_index):
+        headers = dict(SET_PIXEL_HEADERS, Authorization="Bearer " + access_token)
+        body = SET_PIXEL_BODY % (x, y, color_index, canvas_index)
+        try:
+            response = self.session.post(
+                self.gql_url, data=body, headers=headers, timeout=self.timeout
+            )
+        except requests.RequestException as e:
+            logger.error("setPixel request failed: {}", e)
+            return PlacementResult(BAD_RESPONSE, None, None)
+        # decoding the body as text only pays off if someone records debug output
+        logger.opt(lazy=True).debug("Received response: {}", lambda: response.text)
+        return parse_set_pixel(response.content)
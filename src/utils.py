@@ -1,8 +1,16 @@
+import hashlib
 import json
 import os
+import threading
+from contextlib import contextmanager
+import numpy as np
 from PIL import Image, UnidentifiedImageError
 import random
 
+# modules, not names: mappings and template write through atomic_write
+from src import mappings, template
+from src.priority import template_priorities
+
 
 def get_json_data(self, config_path):
     configFilePath = os.path.join(os.getcwd(), config_path)
@@ -19,7 +27,23 @@ def get_json_data(self, config_path):
 
 
 def load_image(self):
-    # Read and load the image to draw and get its dimensions
+    # Use the compiled template next to the image when it is current, so no
+    # image has to be decoded or quantized; otherwise decode the image itself.
+    if load_compiled_template(self):
+        return
+
+    self.template_rgba = decode_image(self)
+    self.quantized_templates = {}
+    quantize_template(self)
+
+    height, width = self.template_rgba.shape[:2]
+    self.logger.info("Loaded image size: {}", (width, height))
+
+    self.image_size = (width, height)
+
+
+def decode_image(self):
+    # Read and load the image to draw as an rgba array
     try:
         im = Image.open(self.image_path)
     except FileNotFoundError:
@@ -32,12 +56,99 @@ def load_image(self):
     if im.mode != "RGBA":
         im = im.convert("RGBA")
         self.logger.info("Converted to rgba")
-    self.pix = im.load()
 
-    self.logger.info("Loaded image size: {}", im.size)
+    return np.asarray(im)
+
+
+def load_compiled_template(self):
+    # True if the compiled template was loaded. It must have been built from the
+    # image on disk (if there is one; a bundled build may ship only the compiled
+    # template) for the configured origin and transparency handling.
+    compiled = template.load_template(self.template_artifact_path)
+    if compiled is None:
+        return False
+    source_hash = hash_file(self.image_path)
+    if (
+        (source_hash is not None and source_hash != compiled.source_hash)
+        or compiled.origin != (self.pixel_x_start, self.pixel_y_start)
+        or compiled.legacy_transparency != self.legacy_transparency
+    ):
+        self.logger.info("Compiled template is stale, loading {}", self.image_path)
+        return False
+
+    priorities = template_priorities(
+        compiled.indices, compiled.opaque, self.importance_mask_path, self.pixel_priority
+    )
+    # the image itself is only decoded if the palette ever differs from the compiled one
+    self.template_rgba = None
+    sparse = template.SparseTemplate(compiled.indices, compiled.opaque, priorities, compiled.coords)
+    self.quantized_templates = {
+        compiled.palette_hash: (compiled.indices, compiled.opaque, priorities, sparse)
+    }
+    quantize_template(self)
+
+    height, width = compiled.indices.shape
+    self.logger.info("Loaded compiled template size: {}", (width, height))
+    self.image_size = (width, height)
+    return True
+
+
+def quantize_template(self):
+    # Keep the template as one byte per pixel: palette indices plus an opaque mask,
+    # and the placement priority of every pixel. The opaque pixels alone are also
+    # kept as a SparseTemplate, which is all the mismatch index looks at.
+    # Results are cached per palette hash, so only a real palette change re-quantizes.
+    cached = self.quantized_templates.get(self.palette.hash)
+    if cached is None:
+        if self.template_rgba is None:
+            self.template_rgba = decode_image(self)
+        indices = self.palette.quantize_image(
+            self.template_rgba,
+            self.legacy_transparency,
+            self.get_lookup_table(self.palette),
+        )
+        opaque = indices != mappings.ColorMapper.TRANSPARENT_INDEX
+        priorities = template_priorities(
+            indices, opaque, self.importance_mask_path, self.pixel_priority
+        )
+        sparse = template.SparseTemplate(indices, opaque, priorities)
+        cached = (indices, opaque, priorities, sparse)
+        self.quantized_templates[self.palette.hash] = cached
+    (
+        self.template_indices,
+        self.template_opaque,
+        self.template_priorities,
+        self.template_sparse,
+    ) = cached
+
+
+@contextmanager
+def atomic_write(path, mode="w"):
+    """Open a private temporary file that replaces path once the block completes.
+
+    Readers, including processes memory-mapping path, never see a partial
+    file. The temporary name is per process and thread, since a client's
+    threads may write the same file at once.
+    """
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def hash_file(path):
+    # sha256 of a file's contents, or None if it doesn't exist
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
 
-    self.image_size = im.size
-    
 def select_user_agent(self):
     user_agents = [
         "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
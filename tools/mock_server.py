@@ -0,0 +1,456 @@
+"""Local stand-in for the r/place GraphQL, frame, template and login endpoints.
+
+Serves everything the client talks to from one port, so it can run and be
+load-tested offline:
+
+- websocket /query: connection_init / connection_ack, the configuration
+  subscription and replace subscriptions with full frames followed by diff
+  frames at a configurable rate
+- POST /query: the setPixel mutation, with per-token cooldowns, rate-limit
+  errors and optionally injected bad responses
+- GET /frames/<name>.png: the frame images referenced by the subscriptions
+- GET /config.json and /image.png: static template hosting from a directory
+- GET/POST /login and GET /session: a login flow that hands out access tokens
+
+Point a client at it with these config.json entries:
+
+    "gql_url": "http://127.0.0.1:8765/query",
+    "gql_ws_url": "ws://127.0.0.1:8765/query",
+    "template_base_url": "http://127.0.0.1:8765",
+    "reddit_login_url": "http://127.0.0.1:8765/login",
+    "reddit_session_url": "http://127.0.0.1:8765/session"
+
+Run with: python -m tools.mock_server --help
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import struct
+import time
+from io import BytesIO
+
+import numpy as np
+from loguru import logger
+from PIL import Image
+
+from src.mappings import Palette
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+TEXT, CLOSE, PING, PONG = 0x1, 0x8, 0x9, 0xA
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def png_bytes(image):
+    buffer = BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class MockPlace:
+    """Board, cooldown and frame state shared by every connection."""
+
+    def __init__(self, args):
+        self.args = args
+        self.palette = Palette.default()
+        self.colors = np.zeros((256, 3), dtype=np.uint8)
+        for color_index, rgb in self.palette.colors.items():
+            self.colors[color_index] = rgb
+        self.rng = np.random.default_rng(args.seed)
+
+        size = args.canvas_size
+        self.canvases = [
+            self.rng.choice(self.palette.color_indices, (size, size)).astype(np.uint8)
+            for _ in range(args.columns * args.rows)
+        ]
+        self.pending = [dict() for _ in self.canvases]  # canvas -> {(x, y): color} since last diff
+        self.timestamps = [now_ms() for _ in self.canvases]
+        self.frames = {}  # frame name -> PNG bytes
+        self.cooldowns = {}  # access token -> next available pixel timestamp (ms)
+        self.subscribers = [set() for _ in self.canvases]  # canvas -> {(connection, id)}
+
+    @property
+    def base_url(self):
+        return "http://{}:{}".format(self.args.host, self.args.port)
+
+    def configuration(self):
+        size = self.args.canvas_size
+        return {
+            "__typename": "ConfigurationMessageData",
+            "colorPalette": {
+                "__typename": "ColorPalette",
+                "colors": [
+                    {"hex": "#%02X%02X%02X" % rgb, "index": index, "__typename": "Color"}
+                    for index, rgb in self.palette.colors.items()
+                ],
+            },
+            "canvasConfigurations": [
+                {
+                    "index": i,
+                    "dx": size * (i % self.args.columns),
+                    "dy": size * (i // self.args.columns),
+                    "__typename": "CanvasConfiguration",
+                }
+                for i in range(len(self.canvases))
+            ],
+            "canvasWidth": size,
+            "canvasHeight": size,
+        }
+
+    def store_frame(self, name, image):
+        self.frames[name] = png_bytes(image)
+        # keep memory bounded on long runs
+        while len(self.frames) > self.args.keep_frames:
+            self.frames.pop(next(iter(self.frames)))
+        return "{}/frames/{}".format(self.base_url, name)
+
+    def full_frame(self, canvas_index):
+        url = self.store_frame(
+            "{}-full-{}.png".format(canvas_index, self.timestamps[canvas_index]),
+            Image.fromarray(self.colors[self.canvases[canvas_index]]),
+        )
+        return {
+            "__typename": "FullFrameMessageData",
+            "name": url,
+            "timestamp": self.timestamps[canvas_index],
+        }
+
+    def next_diff(self, canvas_index):
+        """Apply random placements plus queued setPixels and describe them as a diff frame."""
+        size = self.args.canvas_size
+        changes = self.pending[canvas_index]
+        self.pending[canvas_index] = {}
+        for _ in range(self.rng.poisson(self.args.diff_pixels)):
+            x, y = (int(v) for v in self.rng.integers(0, size, 2))
+            changes[(x, y)] = int(self.rng.choice(self.palette.color_indices))
+
+        rgba = np.zeros((size, size, 4), dtype=np.uint8)
+        canvas = self.canvases[canvas_index]
+        for (x, y), color in changes.items():
+            canvas[y, x] = color
+            rgba[y, x, :3] = self.colors[color]
+            rgba[y, x, 3] = 255
+
+        previous = self.timestamps[canvas_index]
+        current = self.timestamps[canvas_index] = max(now_ms(), previous + 1)
+        url = self.store_frame("{}-diff-{}.png".format(canvas_index, current), Image.fromarray(rgba))
+        return {
+            "__typename": "DiffFrameMessageData",
+            "name": url,
+            "currentTimestamp": current,
+            "previousTimestamp": previous,
+        }
+
+    def set_pixel(self, token, pixel):
+        """Result of a setPixel mutation as (status, body)."""
+        if random.random() < self.args.bad_response_rate:
+            return 200, {"data": None, "errors": [{"message": "internal error"}]}
+
+        available = self.cooldowns.get(token, 0)
+        if now_ms() < available:
+            return 200, {
+                "data": None,
+                "errors": [
+                    {
+                        "message": "Ratelimited",
+                        "extensions": {"nextAvailablePixelTs": available},
+                    }
+                ],
+            }
+
+        canvas_index = pixel["canvasIndex"]
+        x, y = pixel["coordinate"]["x"], pixel["coordinate"]["y"]
+        self.pending[canvas_index][(x, y)] = pixel["colorIndex"]
+        available = self.cooldowns[token] = now_ms() + int(self.args.cooldown * 1000)
+        return 200, {
+            "data": {
+                "act": {
+                    "data": [
+                        {
+                            "id": str(now_ms()),
+                            "data": {
+                                "nextAvailablePixelTimestamp": available,
+                                "__typename": "GetUserCooldownResponseMessageData",
+                            },
+                            "__typename": "BasicMessage",
+                        },
+                        {
+                            "id": str(now_ms()),
+                            "data": {
+                                "timestamp": now_ms(),
+                                "__typename": "SetPixelResponseMessageData",
+                            },
+                            "__typename": "BasicMessage",
+                        },
+                    ],
+                    "__typename": "ActResponse",
+                }
+            }
+        }
+
+
+class WebSocketConnection:
+    """Server side of one RFC 6455 connection (text frames only)."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+
+    async def recv(self):
+        """Next text message, or None once the client closes."""
+        while True:
+            header = await self.reader.readexactly(2)
+            opcode = header[0] & 0x0F
+            length = header[1] & 0x7F
+            if length == 126:
+                (length,) = struct.unpack("!H", await self.reader.readexactly(2))
+            elif length == 127:
+                (length,) = struct.unpack("!Q", await self.reader.readexactly(8))
+            mask = await self.reader.readexactly(4) if header[1] & 0x80 else b"\0\0\0\0"
+            payload = bytearray(await self.reader.readexactly(length))
+            for i in range(length):
+                payload[i] ^= mask[i % 4]
+
+            if opcode == TEXT:
+                return payload.decode()
+            if opcode == PING:
+                await self.send_frame(PONG, bytes(payload))
+            elif opcode == CLOSE:
+                await self.close()
+                return None
+
+    async def send(self, message):
+        await self.send_frame(TEXT, json.dumps(message, separators=(",", ":")).encode())
+
+    async def send_frame(self, opcode, payload):
+        if self.closed:
+            return
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126:
+            header += bytes([len(payload)])
+        elif len(payload) < 1 << 16:
+            header += bytes([126]) + struct.pack("!H", len(payload))
+        else:
+            header += bytes([127]) + struct.pack("!Q", len(payload))
+        self.writer.write(header + payload)
+        await self.writer.drain()
+
+    async def close(self):
+        if not self.closed:
+            try:
+                await self.send_frame(CLOSE, b"")
+            except ConnectionError:
+                pass
+            self.closed = True
+            self.writer.close()
+
+
+class MockServer:
+    def __init__(self, args):
+        self.args = args
+        self.place = MockPlace(args)
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.args.host, self.args.port)
+        logger.info("Mock server listening on {}", self.place.base_url)
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.diff_loop())
+
+    async def diff_loop(self):
+        # every canvas with subscribers gets a diff frame per interval
+        while True:
+            await asyncio.sleep(self.args.diff_interval)
+            for canvas_index, subscribers in enumerate(self.place.subscribers):
+                if not subscribers:
+                    continue
+                diff = self.place.next_diff(canvas_index)
+                for connection, subscription_id in list(subscribers):
+                    if random.random() < self.args.drop_rate:
+                        # a lost message breaks the client's previousTimestamp chain
+                        continue
+                    await self.send_data(connection, subscription_id, diff)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if headers.get("upgrade", "").lower() == "websocket":
+                    await self.handle_websocket(reader, writer, headers)
+                    break
+                status, content_type, payload = self.route(method, path, headers, body)
+                writer.write(
+                    "HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n".format(
+                        status, "OK" if status == 200 else "Error", content_type, len(payload)
+                    ).encode()
+                    + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        method, path, _ = line.decode().split(" ", 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode().strip()
+            if not line:
+                break
+            key, value = line.split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        return method, path.split("?", 1)[0], headers, body
+
+    def route(self, method, path, headers, body):
+        if path == "/query" and method == "POST":
+            token = headers.get("authorization", "").replace("Bearer ", "", 1)
+            request = json.loads(body)
+            if request.get("operationName") != "setPixel":
+                return 400, "application/json", b'{"errors": [{"message": "unsupported"}]}'
+            pixel = request["variables"]["input"]["PixelMessageData"]
+            status, response = self.place.set_pixel(token, pixel)
+            return status, "application/json", json.dumps(response).encode()
+
+        if path.startswith("/frames/"):
+            frame = self.place.frames.get(path[len("/frames/") :])
+            if frame is None:
+                return 404, "text/plain", b"frame expired"
+            return 200, "image/png", frame
+
+        if path in ("/config.json", "/image.png") and self.args.template_dir:
+            file_path = os.path.join(self.args.template_dir, path.lstrip("/"))
+            if os.path.exists(file_path):
+                with open(file_path, "rb") as f:
+                    content_type = "application/json" if path.endswith(".json") else "image/png"
+                    return 200, content_type, f.read()
+            return 404, "text/plain", b"not found"
+
+        if path == "/login":
+            if method == "GET":
+                return 200, "text/html", b'<form><input name="csrf_token" value="mock-csrf"></form>'
+            return 200, "text/html", b"logged in"
+
+        if path == "/session":
+            session = {
+                "user": {
+                    "session": {
+                        "accessToken": "mock-{}".format(random.getrandbits(32)),
+                        "expiresIn": self.args.token_lifetime,
+                    }
+                }
+            }
+            script = '<script id="data">window.__r = {};</script>'.format(json.dumps(session))
+            return 200, "text/html", script.encode()
+
+        return 404, "text/plain", b"not found"
+
+    async def handle_websocket(self, reader, writer, headers):
+        accept = base64.b64encode(
+            hashlib.sha1((headers["sec-websocket-key"] + WS_GUID).encode()).digest()
+        ).decode()
+        writer.write(
+            (
+                "HTTP/1.1 101 Switching Protocols\r\n"
+                "Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                "Sec-WebSocket-Accept: {}\r\n\r\n"
+            ).format(accept).encode()
+        )
+        await writer.drain()
+
+        connection = WebSocketConnection(reader, writer)
+        # clients go quiet after subscribing, so the drop cannot wait for a message
+        deadline = time.time() + self.args.disconnect_after if self.args.disconnect_after else None
+        try:
+            while True:
+                if deadline is None:
+                    message = await connection.recv()
+                else:
+                    try:
+                        message = await asyncio.wait_for(connection.recv(), deadline - time.time())
+                    except asyncio.TimeoutError:
+                        logger.info("Dropping websocket to exercise reconnects")
+                        break
+                if message is None:
+                    break
+                await self.handle_message(connection, json.loads(message))
+        finally:
+            for subscribers in self.place.subscribers:
+                subscribers.difference_update(
+                    {entry for entry in subscribers if entry[0] is connection}
+                )
+            await connection.close()
+
+    async def handle_message(self, connection, message):
+        if message["type"] == "connection_init":
+            await connection.send({"type": "connection_ack"})
+        elif message["type"] == "start":
+            payload = message["payload"]
+            if payload["operationName"] == "configuration":
+                await self.send_data(connection, message["id"], self.place.configuration())
+            elif payload["operationName"] == "replace":
+                canvas_index = int(payload["variables"]["input"]["channel"]["tag"])
+                self.place.subscribers[canvas_index].add((connection, message["id"]))
+                await self.send_data(connection, message["id"], self.place.full_frame(canvas_index))
+        elif message["type"] == "stop":
+            for subscribers in self.place.subscribers:
+                subscribers.discard((connection, message["id"]))
+
+    async def send_data(self, connection, subscription_id, data):
+        await connection.send(
+            {
+                "id": subscription_id,
+                "type": "data",
+                "payload": {
+                    "data": {
+                        "subscribe": {
+                            "id": subscription_id,
+                            "data": data,
+                            "__typename": "BasicMessage",
+                        }
+                    }
+                },
+            }
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the r/place endpoints.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--columns", type=int, default=3, help="canvases per row")
+    parser.add_argument("--rows", type=int, default=2, help="rows of canvases")
+    parser.add_argument("--canvas-size", type=int, default=1000)
+    parser.add_argument("--diff-interval", type=float, default=1.0, help="seconds between diff frames")
+    parser.add_argument("--diff-pixels", type=float, default=50, help="mean random placements per diff")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="share of diff messages to drop")
+    parser.add_argument("--disconnect-after", type=float, default=0, help="drop websockets after N seconds")
+    parser.add_argument("--cooldown", type=float, default=300, help="seconds between placements per token")
+    parser.add_argument("--bad-response-rate", type=float, default=0.0)
+    parser.add_argument("--token-lifetime", type=int, default=3600)
+    parser.add_argument("--template-dir", help="directory holding config.json and image.png")
+    parser.add_argument("--keep-frames", type=int, default=500, help="frame images kept for download")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(MockServer(args).serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Replay a board capture through the board mirror, without any network.
+
+Record a capture by setting "capture_path" in config.json, then:
+
+    python -m tools.replay capture.bin --speed 0
+    python -m tools.replay capture.bin --speed 10 --config config.json
+
+--speed 1 replays at the captured pace, n replays n times faster and 0 as fast
+as possible. With --config the replayed board also drives a client's mismatch
+index and contention tracking for the template in that config, the way the
+live board mirror does. Stage timings are printed at the end.
+"""
+import argparse
+import sys
+import time
+
+from loguru import logger
+
+from benchmarks.synthetic import OfflineClient
+from src.capture import ReplayBoardMirror
+from src.mappings import Palette
+from src.metrics import STAGE_SECONDS, Metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("capture", help="file written with capture_path")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--config", help="client config.json whose template follows the replay")
+    parser.add_argument("--region", type=int, nargs=4, metavar=("LEFT", "TOP", "WIDTH", "HEIGHT"))
+    parser.add_argument("--cache-dir", default=".cache")
+    parser.add_argument(
+        "--frame-processes", type=int, default=0, help="decode frames in this many worker processes"
+    )
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+    client = None
+    if args.config:
+        client = OfflineClient(args.config)
+        metrics = client.metrics
+        lookup_table_provider = client.get_lookup_table
+        region = (client.pixel_x_start, client.pixel_y_start, *client.image_size)
+    else:
+        metrics = Metrics()
+        lookup_tables = {}
+
+        def lookup_table_provider(palette):
+            if palette.hash not in lookup_tables:
+                lookup_tables[palette.hash] = palette.load_lookup_table(args.cache_dir)
+            return lookup_tables[palette.hash]
+
+        # built before the clock starts
+        lookup_table_provider(Palette.default())
+        region = tuple(args.region) if args.region else None
+
+    mirror = ReplayBoardMirror(
+        lookup_table_provider,
+        args.capture,
+        region,
+        args.speed,
+        frame_processes=args.frame_processes,
+        metrics=metrics,
+    )
+    if client is not None:
+        client.board_mirror = mirror
+        mirror.add_listener(client.on_board_change)
+        mirror.add_palette_listener(client.on_palette_change)
+
+    started = time.perf_counter()
+    mirror.start()
+    if client is not None and mirror.wait_ready(client.board_timeout):
+        client.sync_board()
+    mirror.finished.wait()
+    elapsed = time.perf_counter() - started
+
+    print("Replayed {} messages in {:.3f}s".format(mirror.messages, elapsed))
+    for (name, labels), histogram in sorted(metrics.histograms.items()):
+        if name == STAGE_SECONDS and histogram.count:
+            print(
+                "{:<16} {:>7} calls  {:.6f}s mean  {:.3f}s total".format(
+                    dict(labels)["stage"], histogram.count, histogram.sum / histogram.count, histogram.sum
+                )
+            )
+    if client is not None and client.mismatch_index is not None:
+        print("{} template pixels wrong at the end".format(len(client.mismatch_index)))
+        if client.contention is not None:
+            print("Contention: {}".format(client.contention.summary()))
+
+
+if __name__ == "__main__":
+    main()